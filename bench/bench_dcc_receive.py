@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Measure DCC receive throughput and ACK send syscalls per MB from a local loopback sender,
+comparing per-chunk dccmsg events against the recv_into bulk receive mode of DCCConnection
+with an ACK per read, one coalesced ACK per reactor tick, and no ACKs (turbo)
+
+Usage: python bench/bench_dcc_receive.py [megabytes] [bufsize]
+"""
+
+import hashlib
+import pathlib
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'lib' / 'ircbot'))
+
+from ircbot import DCCConnection, Reactor  # type: ignore  # noqa: E402
+
+
+def sender(nbytes: int) -> int:
+    """Serve nbytes once on a loopback port, returns the port"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    def drain_acks(conn):
+        try:
+            while conn.recv(2**16):
+                pass
+        except OSError:
+            pass
+
+    def serve():
+        conn, _ = server.accept()
+        threading.Thread(target=drain_acks, args=(conn,), daemon=True).start()
+        chunk = b'\xa5' * 2**16
+        remaining = nbytes
+        while remaining > 0:
+            remaining -= conn.send(chunk[:min(remaining, len(chunk))])
+        conn.shutdown(socket.SHUT_WR)
+        server.close()
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+class Sink():
+    """Stand-in for a Transfer: write to /dev/null, hash and ACK"""
+    ACK = struct.Struct('!I')
+
+    def __init__(self, connection: DCCConnection) -> None:
+        self.connection = connection
+        self.fileh = open('/dev/null', 'wb')
+        self.md5 = hashlib.md5()
+        self.received = 0
+        self.calls = 0
+        self.acks = 0
+
+    def write(self, data) -> None:
+        self.fileh.write(data)
+        self.md5.update(data)
+        self.received += len(data)
+        self.calls += 1
+
+    def ack(self, *args) -> None:
+        self.connection.send_bytes(self.ACK.pack(self.received & 0xFFFFFFFF))
+        self.acks += 1
+
+
+def run(nbytes: int, mode: str, bufsize: int) -> tuple:
+    reactor = Reactor()
+    connection = DCCConnection(reactor, 'raw')
+    reactor.connections.append(connection)
+    sink = Sink(connection)
+
+    def write_ack(data):
+        sink.write(data)
+        sink.ack()
+
+    start = time.perf_counter()
+    connection.connect('127.0.0.1', sender(nbytes))
+    if mode == 'events':
+        reactor.add_global_handler('dccmsg', lambda c, event: write_ack(event.arguments[0]))
+    elif mode == 'every':
+        connection.receive_into(lambda c, view: write_ack(view), bufsize)
+    elif mode == 'coalesce':
+        connection.receive_into(lambda c, view: sink.write(view), bufsize, sink.ack)
+    else:
+        connection.receive_into(lambda c, view: sink.write(view), bufsize)
+    while getattr(connection, 'connected', False):
+        reactor.process_once(0.01)
+    elapsed = time.perf_counter() - start
+    assert sink.received == nbytes, (sink.received, nbytes)
+    return nbytes / elapsed / 2**20, sink.calls, sink.acks / (nbytes / 2**20)
+
+
+if __name__ == '__main__':
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    bufsize = int(sys.argv[2]) if len(sys.argv) > 2 else 2**18
+    nbytes = megabytes * 2**20
+    for mode in ('events', 'every', 'coalesce', 'turbo'):
+        rate, calls, acks_per_mb = run(nbytes, mode, bufsize)
+        print(f'{mode:10} {rate:8.1f} MB/s  {calls:8} chunks  {acks_per_mb:8.1f} ACK sends/MB')
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Measure CPU time and wakeups of an idle IRC reactor, polling with process_once(0.01) the way
+IRCBot used to against the event-driven run_once, with one idle DCC connection and a 1s timer
+
+Usage: python bench/bench_idle_cpu.py [seconds]
+"""
+
+import pathlib
+import resource
+import socket
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'lib' / 'ircbot'))
+
+from ircbot import DCCConnection, Reactor  # type: ignore  # noqa: E402
+
+
+def idle_reactor() -> tuple:
+    """Reactor with a connected DCC connection whose peer never sends"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    reactor = Reactor()
+    connection = DCCConnection(reactor, 'raw')
+    reactor.connections.append(connection)
+    connection.connect('127.0.0.1', server.getsockname()[1])
+    peer, _ = server.accept()
+    return reactor, (server, peer)
+
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(mode: str, seconds: float) -> tuple:
+    reactor, keep = idle_reactor()
+    ticks = []
+    reactor.call_every(1, lambda: ticks.append(time.monotonic()))
+    wakeups = 0
+    start_cpu = cpu_seconds()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        if mode == 'poll':
+            reactor.process_once(0.01)
+            reactor._run_timers()
+        else:
+            reactor.run_once(max(0., end - time.monotonic()))
+        wakeups += 1
+    cpu = cpu_seconds() - start_cpu
+    assert len(ticks) >= int(seconds) - 1, ticks
+    return cpu / seconds * 100, wakeups / seconds
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for mode in ('poll', 'event'):
+        cpu_pct, wakeups = run(mode, seconds)
+        print(f'{mode:6} {cpu_pct:6.2f}% CPU  {wakeups:8.1f} wakeups/s')
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Compare inserts per second of per-record add_record against bulk add_records
+
+Needs a scratch postgres reachable with POSTGRES_HOST, POSTGRES_DB and POSTGRES_PASSWORD.
+Rows written by the benchmark use a bench- source prefix and are removed afterwards.
+
+Usage: python bench/bench_inventory_inserts.py [records]
+"""
+
+import os
+import pathlib
+import random
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'lib' / 'inventorydb'))
+
+from inventorydb import InventoryDB  # type: ignore  # noqa: E402
+
+
+def announcements(n: int) -> list:
+    """Watchlist-like traffic: a few hundred bots repeating their lists"""
+    rng = random.Random(1)
+    return [(f'bench-bot{rng.randrange(200)}', f'{rng.randrange(1, 900)}M', f'object-{rng.randrange(n // 4)}.bin')
+            for _ in range(n)]
+
+
+def cleanup(db: InventoryDB) -> None:
+    db.execute(lambda cursor: cursor.execute("delete from Inventory where src like 'bench-%';"))
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    db = InventoryDB(os.getenv('POSTGRES_HOST', 'postgres'), os.getenv('POSTGRES_DB'), 'postgres',
+                     os.getenv('POSTGRES_PASSWORD'))
+    records = announcements(n)
+
+    cleanup(db)
+    start = time.perf_counter()
+    for record in records:
+        db.add_record(*record)
+    single_rate = n / (time.perf_counter() - start)
+
+    cleanup(db)
+    start = time.perf_counter()
+    for record in records:
+        db.add_records([record])
+    db.flush_records()
+    bulk_rate = n / (time.perf_counter() - start)
+    cleanup(db)
+
+    print(f'add_record:  {single_rate:10,.0f} records/s')
+    print(f'add_records: {bulk_rate:10,.0f} records/s  {db.stats()}')
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Time inventory searches against a synthetic inventory with and without the trigram and lastseen indexes
+
+Builds a temporary copy of the Inventory schema (dropped with the session), so it is safe to point
+at the live database. Needs POSTGRES_HOST, POSTGRES_DB and POSTGRES_PASSWORD.
+
+Usage: python bench/bench_inventory_search.py [rows]
+"""
+
+import os
+import sys
+import time
+import psycopg2  # type: ignore
+
+SETUP = '''
+create extension if not exists pg_trgm;
+create temp table Inventory (
+    id serial primary key,
+    src text,
+    meta text,
+    name text,
+    created timestamp NOT NULL DEFAULT NOW(),
+    lastseen timestamp NOT NULL DEFAULT NOW(),
+    unique (src, meta, name)
+);
+insert into Inventory (src, meta, name, lastseen)
+    select 'bot' || (i % 500),
+           (i % 900) || 'M',
+           md5(i::text) || '.' || (array['mkv', 'iso', 'zip', 'flac'])[i % 4 + 1],
+           NOW() - (i % 96) * interval '1 hour'
+    from generate_series(1, %s) as i;
+'''
+
+INDEXES = '''
+create index inventory_name_trgm on Inventory using gin (name gin_trgm_ops);
+create index inventory_src_trgm on Inventory using gin (src gin_trgm_ops);
+create index inventory_lastseen on Inventory (lastseen);
+'''
+
+QUERIES = [
+    ('regex name', "select * from Inventory where name ~* %s and lastseen > NOW() - interval '2 days' order by name;",
+     'abc1.*iso'),
+    ('substring name', "select * from Inventory where name ilike %s and lastseen > NOW() - interval '2 days' "
+     'order by name;', '%abc1%'),
+    ('regex src', "select * from Inventory where src ~* %s and lastseen > NOW() - interval '2 days' order by name;",
+     '^bot42$'),
+]
+
+
+def timed(cursor, query: str, param: str, repeat: int = 5) -> tuple:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cursor.execute(query, (param,))
+        rows = len(cursor.fetchall())
+        best = min(best, time.perf_counter() - start)
+    return best, rows
+
+
+def run(cursor) -> dict:
+    cursor.execute('analyze Inventory;')
+    return {label: timed(cursor, query, param) for label, query, param in QUERIES}
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    conn = psycopg2.connect(f"host={os.getenv('POSTGRES_HOST', 'postgres')} user=postgres "
+                            f"dbname={os.getenv('POSTGRES_DB')} password={os.getenv('POSTGRES_PASSWORD')}")
+    conn.autocommit = True
+    cursor = conn.cursor()
+    print(f'building {rows} row inventory', flush=True)
+    cursor.execute(SETUP, (rows,))
+
+    scan = run(cursor)
+    cursor.execute(INDEXES)
+    indexed = run(cursor)
+
+    for label in scan:
+        print(f'{label:15} {scan[label][1]:7} rows  seq scan {scan[label][0] * 1000:9.1f} ms  '
+              f'indexed {indexed[label][0] * 1000:9.1f} ms')
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Compare messages per second of the dict record path against the direct line protocol encoder
+used by mqtt-influx-bridge
+
+Usage: python bench/bench_line_protocol.py [messages]
+"""
+
+import datetime
+import pathlib
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'lib' / 'influxdb'))
+
+from influxdb import LineEncoder  # type: ignore  # noqa: E402
+from influxdb_client import Point, WritePrecision  # type: ignore  # noqa: E402
+
+SENSORS = [f'sensor{i}' for i in range(200)]
+METRICS = ['temperature', 'humidity']
+
+
+def dict_path(n: int) -> float:
+    """Build the per-message dict the bridge used to send and serialize it the way the client does"""
+    start = time.perf_counter()
+    for i in range(n):
+        data_payload = {
+            'measurement': 'environmental',
+            'tags': {
+                'sensor': SENSORS[i % len(SENSORS)]
+            },
+            'time': str(datetime.datetime.utcnow().replace(microsecond=0)),
+            'fields': {
+                METRICS[i & 1]: float(i % 40),
+            }
+        }
+        Point.from_dict(data_payload, WritePrecision.NS).to_line_protocol().encode()
+    return n / (time.perf_counter() - start)
+
+
+def line_path(n: int) -> float:
+    encoder = LineEncoder('environmental', 'sensor')
+    start = time.perf_counter()
+    for i in range(n):
+        encoder.encode(SENSORS[i % len(SENSORS)], METRICS[i & 1], float(i % 40), time.time_ns())
+    return n / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    dict_rate = dict_path(n)
+    line_rate = line_path(n)
+    print(f'dict records: {dict_rate:12,.0f} msg/s')
+    print(f'line protocol: {line_rate:11,.0f} msg/s')
+    print(f'speedup: {line_rate / dict_rate:.1f}x')
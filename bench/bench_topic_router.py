@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Compare TopicRouter dispatch against checking every registered pattern per message
+
+Usage: python bench/bench_topic_router.py [patterns] [messages]
+"""
+
+import pathlib
+import random
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'lib' / 'mqtt'))
+
+from mqtt import TopicRouter  # type: ignore  # noqa: E402
+
+
+def topic_matches(pattern_levels: list, topic: str) -> bool:
+    """Split the topic and compare it against one pattern, the way the bridges match topics today"""
+    topic_levels = topic.split('/')
+    for i, level in enumerate(pattern_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels) or (level != '+' and level != topic_levels[i]):
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+
+def build_patterns(n: int) -> list:
+    patterns = ['Sensors/{location}/{metric}', 'Commands/IRC/{operation}/{target}', 'Commands/ALL', 'Notifications/#']
+    for i in range(n - len(patterns)):
+        kind = i % 4
+        if kind == 0:
+            patterns.append(f'Site{i}/{{location}}/{{metric}}')
+        elif kind == 1:
+            patterns.append(f'Devices/dev{i}/+/state')
+        elif kind == 2:
+            patterns.append(f'Devices/dev{i}/#')
+        else:
+            patterns.append(f'Fleet/{{group}}/unit{i}/telemetry')
+    return patterns
+
+
+def build_topics(n: int, patterns: int) -> list:
+    rng = random.Random(1)
+    topics = []
+    for _ in range(n):
+        i = rng.randrange(patterns)
+        topics.append(rng.choice([
+            f'Sensors/room{i % 50}/temperature',
+            f'Site{i}/room{i % 7}/humidity',
+            f'Devices/dev{i}/relay/state',
+            f'Fleet/north/unit{i}/telemetry',
+            'Commands/ALL',
+        ]))
+    return topics
+
+
+def run(patterns: list, topics: list) -> None:
+    router = TopicRouter()
+    for pattern in patterns:
+        router.add(pattern, pattern)
+
+    start = time.perf_counter()
+    trie_hits = sum(len(router.match(topic)) for topic in topics)
+    trie_rate = len(topics) / (time.perf_counter() - start)
+
+    compiled = [TopicRouter.subscription(pattern).split('/') for pattern in patterns]
+    sample = topics[:max(1, len(topics) // 20)]
+    start = time.perf_counter()
+    linear_hits = sum(1 for topic in sample for levels in compiled if topic_matches(levels, topic))
+    linear_rate = len(sample) / (time.perf_counter() - start)
+
+    assert linear_hits == sum(len(router.match(topic)) for topic in sample)
+    print(f'{len(patterns)} patterns, {trie_hits} matches over {len(topics)} messages')
+    print(f'trie:   {trie_rate:12,.0f} msg/s')
+    print(f'linear: {linear_rate:12,.0f} msg/s')
+    print(f'speedup: {trie_rate / linear_rate:.0f}x')
+
+
+if __name__ == '__main__':
+    npatterns = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    nmessages = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    run(build_patterns(npatterns), build_topics(nmessages, npatterns))
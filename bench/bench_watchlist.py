@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Replay an IRC log through the watchlist handler, comparing WatchlistMatcher against the per-line
+re.match and list membership check it replaced
+
+The log has one "target message" line per event, e.g. "#channel #12  3x [1.2G] name.iso".
+Without a log a synthetic one of busy channels is generated.
+
+Usage: python bench/bench_watchlist.py [logfile] [watchlist channels separated by ;]
+"""
+
+import pathlib
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'lib' / 'ircbot'))
+
+from ircbot import WatchlistMatcher  # type: ignore  # noqa: E402
+
+
+def synthetic_log(n: int = 500000) -> list:
+    rng = random.Random(1)
+    channels = [f'#chan{i}' for i in range(20)]
+    chatter = ['anyone seen the new release?', 'brb', 'lol that is not how it works', 'ping timeout again',
+               'Type "/msg bot xdcc send #1" to request a pack', '** 3 packs ** 1 of 10 slots open']
+    events = []
+    for i in range(n):
+        channel = rng.choice(channels)
+        if rng.random() < 0.3:
+            size = f'{rng.randint(1, 999)}{rng.choice("KMG")}'
+            name = f'file.{i}.{rng.choice(["mkv", "iso"])}'
+            events.append((channel, f'#{i % 5000:<5} {rng.randint(1, 99)}x [{size}] {name}'))
+        else:
+            events.append((channel, rng.choice(chatter)))
+    return events
+
+
+def read_log(path: str) -> list:
+    events = []
+    with open(path, errors='replace') as fileh:
+        for line in fileh:
+            target, _, message = line.rstrip('\n').partition(' ')
+            events.append((target, message))
+    return events
+
+
+def before(watchlist: list, events: list) -> tuple:
+    hits = 0
+    start = time.perf_counter()
+    for target, message in events:
+        if target in watchlist:
+            extract = re.match(r'.{4,16} +\d+x \[([^\]]+)\] (.*)', message)
+            if extract:
+                b'\x00'.join([s.encode() for s in ('nick', extract.group(1), extract.group(2))])
+                hits += 1
+    return len(events) / (time.perf_counter() - start), hits
+
+
+def after(watchlist: list, events: list) -> tuple:
+    matcher = WatchlistMatcher(watchlist)
+    hits = 0
+    start = time.perf_counter()
+    for target, message in events:
+        if target in matcher.channels:
+            extract = matcher.match(target, message)
+            if extract:
+                meta, name = extract
+                f'nick\x00{meta}\x00{name}'.encode()
+                hits += 1
+    return len(events) / (time.perf_counter() - start), hits
+
+
+if __name__ == '__main__':
+    events = read_log(sys.argv[1]) if len(sys.argv) > 1 else synthetic_log()
+    if len(sys.argv) > 2:
+        watchlist = sys.argv[2].split(';')
+    else:
+        watchlist = sorted({target for target, _ in events if target.startswith('#')})[::2]
+    before_rate, before_hits = before(watchlist, events)
+    after_rate, after_hits = after(watchlist, events)
+    assert before_hits == after_hits, (before_hits, after_hits)
+    print(f'{len(events)} lines, {len(watchlist)} watched channels, {after_hits} announcements')
+    print(f're.match: {before_rate:12,.0f} lines/s')
+    print(f'matcher:  {after_rate:12,.0f} lines/s')
+    print(f'speedup: {after_rate / before_rate:.1f}x')
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Check the 1 minute and 1 hour WindowAggregator output against an offline group-by over the same readings,
+also across a restart in mid-window that reopens the open windows from what was written at shutdown
+
+Usage: python bench/check_aggregator.py [hours] [sensors]
+"""
+
+import collections
+import datetime
+import math
+import pathlib
+import random
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'lib' / 'influxdb'))
+
+from influxdb import WindowAggregator  # type: ignore  # noqa: E402
+
+WINDOWS = (('1m', 60), ('1h', 3600))
+FIELDS = ['temperature', 'humidity']
+
+
+def readings(hours: int, sensors: int) -> list:
+    """Time ordered (sensor, field, value, timestamp_ns) with uneven gaps, some minutes have no readings"""
+    rng = random.Random(1)
+    t = 1700000000 * 10**9
+    end = t + hours * 3600 * 10**9
+    out = []
+    while t < end:
+        t += rng.choice([rng.randrange(10**9, 20 * 10**9), rng.randrange(60 * 10**9, 200 * 10**9)])
+        sensor = f'sensor {rng.randrange(sensors)}'
+        field = rng.choice(FIELDS)
+        value = rng.randrange(-400, 400) if rng.random() < 0.2 else rng.uniform(-40.0, 40.0)
+        out.append((sensor, field, value, t))
+    return out
+
+
+def offline(rows: list) -> dict:
+    groups = collections.defaultdict(list)
+    for sensor, field, value, t in rows:
+        for label, seconds in WINDOWS:
+            size = seconds * 10**9
+            groups[(f'environmental_{label}', sensor, field, t - t % size)].append(value)
+    return {key: (min(values), max(values), sum(values) / len(values), len(values)) for key, values in groups.items()}
+
+
+def parse(line: bytes) -> tuple:
+    head, fields, start = line.decode().rsplit(' ', 2)
+    measurement, tag = head.replace('\\ ', ' ').split(',', 1)
+    sensor = tag.split('=', 1)[1]
+    values = dict(field.split('=', 1) for field in fields.split(','))
+    field = next(iter(values)).rsplit('_', 1)[0]
+    return ((measurement, sensor, field, int(start)),
+            (float(values[f'{field}_min']), float(values[f'{field}_max']), float(values[f'{field}_mean']),
+             int(values[f'{field}_count'].rstrip('i'))))
+
+
+class Record():
+    """The parts of an influxdb_client FluxRecord that WindowAggregator.seed() reads"""
+    def __init__(self, measurement: str, sensor: str, field: str, start: int, value) -> None:
+        self.measurement, self.field, self.value = measurement, field, value
+        self.time = datetime.datetime.fromtimestamp(start / 1e9, datetime.timezone.utc)
+        self.values = {'sensor': sensor}
+
+    def get_measurement(self) -> str:
+        return self.measurement
+
+    def get_field(self) -> str:
+        return self.field
+
+    def get_time(self) -> datetime.datetime:
+        return self.time
+
+    def get_value(self):
+        return self.value
+
+
+def stored(lines: list) -> list:
+    """Flux tables of the points written, one record per field as a query with last() returns them"""
+    records = []
+    for line in lines:
+        (measurement, sensor, field, start), stats = parse(line)
+        for stat, value in zip(('min', 'max', 'mean', 'count'), stats):
+            records.append(Record(measurement, sensor, f'{field}_{stat}', start, value))
+    return [records]
+
+
+def check(streamed: dict, expected: dict) -> None:
+    assert streamed.keys() == expected.keys(), set(streamed) ^ set(expected)
+    for key, (low, high, mean, count) in expected.items():
+        got = streamed[key]
+        assert math.isclose(got[0], low) and math.isclose(got[1], high), (key, got, expected[key])
+        assert math.isclose(got[2], mean, rel_tol=1e-9, abs_tol=1e-9), (key, got, expected[key])
+        assert got[3] == count, (key, got, expected[key])
+
+
+if __name__ == '__main__':
+    hours = int(sys.argv[1]) if len(sys.argv) > 1 else 6
+    sensors = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    rows = readings(hours, sensors)
+
+    lines = []
+    aggregator = WindowAggregator(lines.append, 'environmental', 'sensor', WINDOWS)
+    for row in rows:
+        aggregator.add(*row)
+    aggregator.expire(rows[-1][3] + 10**13)
+    assert aggregator.next_close() is None
+
+    streamed = dict(parse(line) for line in lines)
+    expected = offline(rows)
+    assert len(streamed) == len(lines), 'window written twice'
+    check(streamed, expected)
+    print(f'OK: {len(rows)} readings, {len(lines)} windows match the offline aggregation, {aggregator.late} late')
+
+    # restart in the middle of an hour: flush on shutdown, reopen from the written points, later points win
+    cut = len(rows) // 2 + 7
+    restart = rows[cut - 1][3] + 10**9
+    lines = []
+    before = WindowAggregator(lines.append, 'environmental', 'sensor', WINDOWS)
+    for row in rows[:cut]:
+        before.add(*row)
+    before.expire(restart, force=True)
+    after = WindowAggregator(lines.append, 'environmental', 'sensor', WINDOWS)
+    reopened = after.seed(stored(lines), restart)
+    assert reopened, 'no window open at the restart'
+    for row in rows[cut:]:
+        after.add(*row)
+    after.expire(rows[-1][3] + 10**13)
+    check(dict(parse(line) for line in lines), expected)
+    print(f'OK: restart reopened {reopened} windows, {len(lines)} points written match the offline aggregation')
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Check AsyncMQTT against a broker: {name} captures reach subscribers in order, a full subscriber pauses
+reading without losing messages, and the connection survives a pause longer than the keepalive
+
+Usage: MQTT_BROKER=localhost python bench/check_async_mqtt.py [messages] [keepalive]
+"""
+
+import asyncio
+import os
+import pathlib
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'lib' / 'mqtt'))
+
+from mqtt import AsyncMQTT  # type: ignore  # noqa: E402
+
+
+class CheckedMQTT(AsyncMQTT):
+    """Counts disconnects and how long reading was paused"""
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.disconnects = 0
+        self.paused_since = None
+        self.paused = 0.
+
+    def on_disconnect(self, *args) -> None:
+        self.disconnects += 1
+        super().on_disconnect(*args)
+
+    def _update_reading(self) -> None:
+        super()._update_reading()
+        if not self.reading and self.paused_since is None:
+            self.paused_since = time.monotonic()
+        elif self.reading and self.paused_since is not None:
+            self.paused += time.monotonic() - self.paused_since
+            self.paused_since = None
+
+
+async def main(host: str, messages: int, keepalive: int) -> None:
+    tag = os.getpid()
+    subscriber = CheckedMQTT(host, keepalive=keepalive, client_id=f'check-async-sub-{tag}')
+    publisher = AsyncMQTT(host, client_id=f'check-async-pub-{tag}')
+    await subscriber.listen()
+    await publisher.listen()
+    subscription = subscriber.subscribe(f'Check/{tag}/{{room}}/{{metric}}', qos=1, maxsize=5)
+    await asyncio.sleep(0.5)  # SUBACK
+
+    for i in range(messages):
+        await publisher.publish(f'Check/{tag}/room{i % 3}/temperature', str(i), qos=1)
+    # nobody consumes for longer than the keepalive, the subscriber must stay connected
+    await asyncio.sleep(keepalive * 3)
+    paused = subscriber.paused + (time.monotonic() - subscriber.paused_since if subscriber.paused_since else 0)
+    assert paused > keepalive, f'a full subscriber kept reading, paused for {paused:.1f}s'
+
+    seen = {}
+
+    async def consume():
+        async for msg, captures in subscription:
+            assert captures['metric'] == 'temperature', captures
+            seen.setdefault(captures['room'], []).append(int(msg.payload))
+            if sum(map(len, seen.values())) == messages:
+                return
+    try:
+        await asyncio.wait_for(consume(), 30)
+    except asyncio.TimeoutError:
+        raise AssertionError(f'only {sum(map(len, seen.values()))} of {messages} messages arrived, '
+                             f'{subscriber.disconnects} disconnects')
+    subscriber._update_reading()
+    for room, values in seen.items():
+        assert values == sorted(values), f'{room} out of order'
+        assert all(int(room[4:]) == value % 3 for value in values), f'{room} got another room'
+    assert subscriber.disconnects == 0, f'{subscriber.disconnects} disconnects while paused'
+    print(f'OK: {messages} messages over {len(seen)} rooms, reading paused {paused:.1f}s '
+          f'with a {keepalive}s keepalive')
+    await subscriber.stop()
+    await publisher.stop()
+
+
+if __name__ == '__main__':
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    keepalive = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    asyncio.run(main(os.getenv('MQTT_BROKER', 'localhost'), messages, keepalive))
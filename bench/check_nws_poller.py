@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Run the nwsapi-influx-bridge polling engine against a local stub of api.weather.gov and check that it
+polls stations concurrently over reused connections, skips unchanged observations through conditional
+requests and gives up on a slow station after its own timeout
+
+Usage: python bench/check_nws_poller.py [stations] [delay]
+"""
+
+import concurrent.futures
+import email.utils
+import http.server
+import importlib.util
+import json
+import pathlib
+import sys
+import threading
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'lib' / 'influxdb'))
+sys.path.insert(0, str(ROOT / 'lib' / 'normalize'))
+
+spec = importlib.util.spec_from_file_location('nwsapi_bridge',
+                                              ROOT / 'nwsapi-influx-bridge' / 'nwsapi-influx-bridge.py')
+bridge = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(bridge)
+
+
+class StubNWS(http.server.ThreadingHTTPServer):
+    """Serves /stations/<id>/observations/latest with an ETag and Last-Modified per observation"""
+    daemon_threads = True
+
+    def __init__(self, delay: float, slow: str) -> None:
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.delay = delay
+        self.slow = slow
+        self.observations = {}  # station: timestamp
+        self.lock = threading.Lock()
+        self.counts = {'200': 0, '304': 0, 'inflight': 0, 'max_inflight': 0}
+        self.peers = set()
+
+    def count(self, key: str, n: int = 1) -> None:
+        with self.lock:
+            self.counts[key] += n
+            self.counts['max_inflight'] = max(self.counts['max_inflight'], self.counts['inflight'])
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self) -> None:
+        server = self.server
+        station = self.path.split('/')[2]
+        server.peers.add(self.client_address)
+        server.count('inflight')
+        time.sleep(server.delay * (10 if station == server.slow else 1))
+        server.count('inflight', -1)
+
+        timestamp = server.observations.setdefault(station, '2024-01-01T00:00:00+00:00')
+        etag = f'"{station}-{timestamp}"'
+        if self.headers.get('If-None-Match') == etag:
+            server.count('304')
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        body = json.dumps({'properties': {
+            'timestamp': timestamp,
+            'temperature': {'value': 21.5, 'unitCode': 'wmoUnit:degC'},
+            'relativeHumidity': {'value': 40.0, 'unitCode': 'wmoUnit:percent'},
+        }}).encode()
+        server.count('200')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/geo+json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', email.utils.formatdate(usegmt=True))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except BrokenPipeError:
+            pass  # the client timed out on the slow station
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def poll_round(poller, stations: list, pool, written: list) -> float:
+    schedule = bridge.PollSchedule(stations, 0, 0)
+    start = time.perf_counter()
+    bridge.poll_stations(poller, schedule, pool, lambda *record: written.append(record))
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    nstations = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+    concurrency = 4
+    stations = [f'K{i:03}' for i in range(nstations)]
+    slow = stations[-1]
+
+    server = StubNWS(delay, slow)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    poller = bridge.WeatherPoller(f'http://127.0.0.1:{server.server_address[1]}', concurrency,
+                                  timeout=delay * 5, timeouts={slow: delay * 2})
+
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        written = []
+        first = poll_round(poller, stations, pool, written)
+        assert len(written) == nstations - 1, 'every station but the slow one is written'
+        assert server.counts['max_inflight'] <= concurrency + 1, server.counts
+        print(f'first round  {first:6.2f}s  {len(written)} written, serial would take {nstations * delay:.2f}s')
+
+        server.observations[stations[0]] = '2024-01-01T00:20:00+00:00'
+        written = []
+        second = poll_round(poller, stations[:-1], pool, written)
+        assert [record[0] for record in written] == [stations[0]], written
+        print(f'second round {second:6.2f}s  {len(written)} written, {server.counts["304"]} not modified')
+
+    time.sleep(delay * 10)
+    print(f'{server.counts["200"] + server.counts["304"]} requests over {len(server.peers)} connections, '
+          f'at most {server.counts["max_inflight"]} in flight')
+    assert len(server.peers) <= concurrency + 1, server.peers
+    server.shutdown()
+    print('OK')
@@ -4,7 +4,6 @@ Python Inventory Object Management and Retrieval through MQTT Broker (tested wit
 Author: Pete Ezzo <peter.ezzo@gmail.com>
 """
 
-import collections
 import os
 import random
 import sys
@@ -20,45 +19,51 @@ class InvenCLI():
         self.mqtt_broker = os.getenv('MQTT_BROKER')
         self.preamble = os.getenv('PREAMBLE')
 
-    def names(self, data: str) -> None:
-        results = self.db.search_all(data)
+    def names(self, data: str, substring: bool = False) -> None:
+        results = self.db.iter_search_all(data, substring)
         for result in results:
             print(f'{result[1]} {result[3]} : {result[2]}')
 
-    def unames(self, data: str) -> None:
-        results = self.db.search_names(data)
+    def unames(self, data: str, substring: bool = False) -> None:
+        results = self.db.iter_search_names(data, substring)
         for result in results:
             print(f'{result[0]} : {result[1]}')
 
-    def sources(self, data: str) -> None:
-        results = self.db.search_all_by_src(data)
+    def sources(self, data: str, substring: bool = False) -> None:
+        results = self.db.iter_search_all_by_src(data, substring)
         for result in results:
             print(f'{result[3]} : {result[2]}')
 
-    def get(self, data: str, dryrun: bool) -> None:
+    def get(self, data: str, dryrun: bool, page_size: int = 100) -> None:
+        """Queue matching objects with the IRC bridge scheduler, which picks and retries sources"""
         cmds = []
-        objmap = collections.defaultdict(lambda: set())
-        for name, source in [(r[3], r[1]) for r in self.db.search_all(data)]:
-            objmap[name].add(source)
-        for name, sources in {k: list(objmap[k]) for k in sorted(objmap, key=lambda k: len(objmap[k]))}.items():
-            target = sources[random.randint(0, len(sources) - 1)]
-            payload = f'{self.preamble} {name}'
-            cmds.append((f'Commands/IRC/privmsg/{target}', payload, 2, False))
+        # rows arrive grouped by name, fewest sources first
+        for name, sources in self.db.iter_sources_by_name(data):
+            random.shuffle(sources)
+            message = f'{self.preamble} {name}'
+            print(message, 'from', ', '.join(sources), flush=True)
+            payload = '\x00'.join([message, name, *sources]).encode()
+            cmds.append(('Commands/IRC/queue', payload, 2, False))
+            if len(cmds) >= page_size:
+                self.publish(cmds, dryrun)
+                cmds = []
+        self.publish(cmds, dryrun)
 
-        print('\n'.join([c[1] for c in cmds]))
-        if not dryrun:
+    def publish(self, cmds: list, dryrun: bool) -> None:
+        if cmds and not dryrun:
             multiple(cmds, hostname=self.mqtt_broker)
 
 
 if __name__ == '__main__':
     inventory = InvenCLI()
+    substring = '-s' in sys.argv  # plain substring match instead of regex
     if len(sys.argv) < 3:
-        print('Unrecognized command, try: names, unames, find, sources, get')
+        print('Unrecognized command, try: names, unames, find, sources, get (-s for substring match)')
     elif sys.argv[1][:2] == 'na':
-        inventory.names(sys.argv[2])
+        inventory.names(sys.argv[2], substring)
     elif sys.argv[1][:2] == 'un' or sys.argv[1][:2] == 'fi':
-        inventory.unames(sys.argv[2])
+        inventory.unames(sys.argv[2], substring)
     elif sys.argv[1][:2] == 'so':
-        inventory.sources(sys.argv[2])
+        inventory.sources(sys.argv[2], substring)
     elif sys.argv[1][:2] == 'ge':
         inventory.get(sys.argv[2], '-n' in sys.argv)
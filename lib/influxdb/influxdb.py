@@ -4,12 +4,437 @@ Python object to work with InfluxDB2 using credentials from configuration files
 Author: Pete Ezzo <peter.ezzo@gmail.com>
 """
 
+import collections
+import math
+import os
+import pathlib
 import sys
+import threading
+import time
 import influxdb_client  # type: ignore
 
 
+def escape_measurement(name: str) -> str:
+    """Escape a measurement name for line protocol"""
+    return name.replace(',', '\\,').replace(' ', '\\ ')
+
+
+def escape_key(key: str) -> str:
+    """Escape a tag key, tag value or field key for line protocol"""
+    return key.replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def format_field(value) -> str | None:
+    """Format a field value for line protocol, None for NaN and infinity which influxdb rejects"""
+    if isinstance(value, float):
+        return repr(value) if math.isfinite(value) else None
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return f'{value}i'
+    if isinstance(value, bytes):
+        value = value.decode()
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{value}"'
+
+
+class LineEncoder():
+    """
+    Encode single-field points straight to line protocol bytes
+
+    The measurement and tag set only vary by one tag value (e.g. the sensor name),
+    so the escaped prefix is built once per tag value and reused for every point.
+    """
+    def __init__(self, measurement: str, tag: str) -> None:
+        self.head = f'{escape_measurement(measurement)},{escape_key(tag)}='
+        self.prefixes = {}
+        self.fields = {}
+
+    def encode(self, tag_value: str, field: str, value, timestamp_ns: int) -> bytes | None:
+        """Returns None for a value that cannot be stored, like the client skipping non-finite floats"""
+        formatted = format_field(value)
+        if formatted is None:
+            return None
+        prefix = self.prefixes.get(tag_value)
+        if prefix is None:
+            prefix = self.prefixes[tag_value] = f'{self.head}{escape_key(tag_value)} '
+        key = self.fields.get(field)
+        if key is None:
+            key = self.fields[field] = f'{escape_key(field)}='
+        return f'{prefix}{key}{formatted} {timestamp_ns}'.encode()
+
+
+class WindowAggregator():
+    """
+    Rolling min/max/mean/count of numeric fields per tag value over tumbling windows aligned to the epoch
+
+    Each window size is written as its own measurement (e.g. environmental_1m) with {field}_min,
+    {field}_max, {field}_mean and {field}_count fields, stamped with the window start. Memory is one
+    running window per (size, tag value, field). A window is written when a reading for a later window
+    arrives or once expire() sees it closed for grace seconds, readings for a window already written
+    are counted as late and dropped. After a restart seed() reopens the windows written at shutdown.
+    """
+    def __init__(self, sink, measurement: str, tag: str, windows: tuple = (('1m', 60), ('1h', 3600)),
+                 grace: float = 5.0) -> None:
+        self.sink = sink
+        self.windows = [(f'{escape_measurement(measurement)}_{label}', int(seconds * 1e9))
+                        for label, seconds in windows]
+        self.measurements = [f'{measurement}_{label}' for label, _ in windows]
+        self.tag = escape_key(tag)
+        self.tag_name = tag
+        self.grace = int(grace * 1e9)
+        self.state = {}  # (window index, tag value, field): [start, min, max, total, count], count 0 once written
+        self.late = 0
+        self.lock = threading.Lock()
+
+    def add(self, tag_value: str, field: str, value, timestamp_ns: int) -> None:
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            return
+        lines = []
+        with self.lock:
+            for i, (_, size) in enumerate(self.windows):
+                start = timestamp_ns - timestamp_ns % size
+                key = (i, tag_value, field)
+                window = self.state.get(key)
+                if window is None or window[0] < start:
+                    if window is not None and window[4]:
+                        lines.append(self._line(key, window))
+                    self.state[key] = [start, value, value, value, 1]
+                elif window[0] > start or not window[4]:
+                    self.late += 1
+                else:
+                    if value < window[1]:
+                        window[1] = value
+                    if value > window[2]:
+                        window[2] = value
+                    window[3] += value
+                    window[4] += 1
+        for line in lines:
+            self.sink(line)
+
+    def seed(self, tables, now_ns: int = None) -> int:
+        """
+        Reopen the windows still open at now_ns from a Flux query result holding their last written
+        {field}_min/_max/_mean/_count points, so readings after a restart merge with the partial window
+        written at shutdown instead of overwriting it. Returns the number of windows reopened.
+        """
+        now_ns = time.time_ns() if now_ns is None else now_ns
+        points = collections.defaultdict(dict)  # (window index, tag value, field, start): {stat: value}
+        for table in tables:
+            for record in table:
+                try:
+                    i = self.measurements.index(record.get_measurement())
+                except ValueError:
+                    continue
+                field, _, stat = record.get_field().rpartition('_')
+                start = round(record.get_time().timestamp()) * 10**9
+                if field and start <= now_ns < start + self.windows[i][1]:
+                    points[(i, record.values.get(self.tag_name), field, start)][stat] = record.get_value()
+        seeded = 0
+        with self.lock:
+            for (i, tag_value, field, start), stats in points.items():
+                if not {'min', 'max', 'mean', 'count'} <= stats.keys() or not stats['count']:
+                    continue
+                key = (i, tag_value, field)
+                window = self.state.get(key)
+                if window is not None and window[0] >= start:
+                    continue
+                count = int(stats['count'])
+                self.state[key] = [start, stats['min'], stats['max'], stats['mean'] * count, count]
+                seeded += 1
+        return seeded
+
+    def expire(self, now_ns: int = None, force: bool = False) -> int:
+        """
+        Write every window that closed at least grace seconds ago, or every open window with force
+        (on shutdown, seed() picks the partial window up again after a restart).
+        Returns the number written.
+        """
+        now_ns = time.time_ns() if now_ns is None else now_ns
+        lines = []
+        with self.lock:
+            for key, window in self.state.items():
+                if window[4] and (force or window[0] + self.windows[key[0]][1] + self.grace <= now_ns):
+                    lines.append(self._line(key, window))
+                    window[4] = 0
+        for line in lines:
+            self.sink(line)
+        return len(lines)
+
+    def next_close(self, now_ns: int = None) -> float | None:
+        """Seconds until expire() has a window to write, None while no window is open"""
+        now_ns = time.time_ns() if now_ns is None else now_ns
+        with self.lock:
+            closes = [window[0] + self.windows[key[0]][1] + self.grace
+                      for key, window in self.state.items() if window[4]]
+        return max(0., (min(closes) - now_ns) / 1e9) if closes else None
+
+    def _line(self, key: tuple, window: list) -> bytes:
+        i, tag_value, field = key
+        start, low, high, total, count = window
+        field = escape_key(field)
+        return (f'{self.windows[i][0]},{self.tag}={escape_key(tag_value)} '
+                f'{field}_min={format_field(float(low))},{field}_max={format_field(float(high))},'
+                f'{field}_mean={format_field(total / count)},{field}_count={count}i {start}').encode()
+
+
+class BatchWriter():
+    """
+    Buffer records in a bounded in-memory queue and hand them to a sink in batches from a background thread
+
+    A batch is sent once batch_size records are waiting or flush_interval seconds have passed.
+    When the queue is full the overflow policy decides what happens to new records:
+      block        wait up to block_timeout seconds for room, then drop the new record
+      drop-oldest  discard the oldest queued record to make room
+      drop-newest  discard the new record
+    """
+    OVERFLOW_POLICIES = ('block', 'drop-oldest', 'drop-newest')
+
+    def __init__(self, sink, batch_size=1000, flush_interval=1.0, max_queue=50000,
+                 overflow='drop-oldest', block_timeout=5.0):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {overflow}, expected one of {self.OVERFLOW_POLICIES}')
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.inflight = 0
+        self.flush_requested = False
+        self.closed = False
+        self.counters = {
+            'batches': 0,
+            'written': 0,
+            'dropped': 0,
+            'errors': 0,
+            'max_queue_depth': 0,
+            'last_batch_latency': 0.0,
+            'max_batch_latency': 0.0,
+            'total_batch_latency': 0.0,
+        }
+
+        self.thread = threading.Thread(target=self._run, name='influx-writer', daemon=True)
+        self.thread.start()
+
+    def put(self, record) -> bool:
+        """Queue a record for writing, returns False if the record was dropped"""
+        with self.cond:
+            if self.closed:
+                raise RuntimeError('BatchWriter is closed')
+            if len(self.queue) >= self.max_queue:
+                if self.overflow == 'block':
+                    if not self.cond.wait_for(lambda: len(self.queue) < self.max_queue or self.closed,
+                                              self.block_timeout):
+                        self.counters['dropped'] += 1
+                        return False
+                elif self.overflow == 'drop-newest':
+                    self.counters['dropped'] += 1
+                    return False
+                else:
+                    self.queue.popleft()
+                    self.counters['dropped'] += 1
+            self.queue.append(record)
+            depth = len(self.queue)
+            if depth > self.counters['max_queue_depth']:
+                self.counters['max_queue_depth'] = depth
+            if depth >= self.batch_size:
+                self.cond.notify_all()
+        return True
+
+    def flush(self, timeout=None) -> bool:
+        """Send everything queued so far, returns False if the timeout expired first"""
+        with self.cond:
+            self.flush_requested = True
+            self.cond.notify_all()
+            return self.cond.wait_for(lambda: not self.queue and not self.inflight, timeout)
+
+    def close(self, timeout=None) -> None:
+        """Flush remaining records and stop the writer thread"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join(timeout)
+
+    def stats(self) -> dict:
+        with self.cond:
+            stats = dict(self.counters)
+            stats['queue_depth'] = len(self.queue)
+        total_latency = stats.pop('total_batch_latency')
+        stats['avg_batch_latency'] = total_latency / stats['batches'] if stats['batches'] else 0.0
+        return stats
+
+    def _run(self) -> None:
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: len(self.queue) >= self.batch_size or self.flush_requested or self.closed,
+                                   self.flush_interval)
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+                if not self.queue:
+                    self.flush_requested = False
+                self.inflight = len(batch)
+                # wake producers blocked on a full queue
+                self.cond.notify_all()
+
+            if batch:
+                self._send(batch)
+
+            with self.cond:
+                self.inflight = 0
+                self.cond.notify_all()
+                if self.closed and not self.queue:
+                    return
+
+    def _send(self, batch: list) -> None:
+        start = time.monotonic()
+        try:
+            self.sink(batch)
+        except Exception as e:
+            print(f'ERROR: dropped batch of {len(batch)} records: {str(e)}', flush=True)
+            with self.cond:
+                self.counters['errors'] += 1
+                self.counters['dropped'] += len(batch)
+            return
+        latency = time.monotonic() - start
+        with self.cond:
+            self.counters['batches'] += 1
+            self.counters['written'] += len(batch)
+            self.counters['last_batch_latency'] = latency
+            self.counters['total_batch_latency'] += latency
+            if latency > self.counters['max_batch_latency']:
+                self.counters['max_batch_latency'] = latency
+
+
+class Spool():
+    """
+    Append-only on-disk spool of line protocol batches, split into numbered segment files
+
+    Lines are appended to the newest segment and read back from the oldest one, so replay
+    happens in the order the batches were spooled. When the spool grows past max_size the
+    oldest segments are evicted. A crash mid-replay may resend part of a segment, which is
+    harmless because influxdb overwrites points with identical series and timestamp. A crash
+    mid-append leaves a partial last line, which is cut off once that segment is read back.
+    """
+    SUFFIX = '.lp'
+
+    def __init__(self, path, segment_size=4 * 2**20, max_size=256 * 2**20) -> None:
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        self.segments = collections.deque(sorted(self.path.glob(f'*{self.SUFFIX}')))
+        self.size = sum(segment.stat().st_size for segment in self.segments)
+        self.read_offset = 0
+        self.generation = 0  # bumped whenever the oldest segment is evicted
+        self.fileh = None
+        self.counters = {'spooled': 0, 'replayed': 0, 'evicted_segments': 0, 'torn_lines': 0}
+
+    def pending(self) -> bool:
+        with self.lock:
+            return bool(self.segments)
+
+    def append(self, lines: list) -> None:
+        data = b'\n'.join(lines) + b'\n'
+        with self.lock:
+            if not self.fileh or self.fileh.tell() >= self.segment_size:
+                self._rotate()
+            self.fileh.write(data)
+            self.fileh.flush()
+            os.fsync(self.fileh.fileno())
+            self.size += len(data)
+            self.counters['spooled'] += len(lines)
+            while self.size > self.max_size and len(self.segments) > 1:
+                self._evict()
+                self.counters['evicted_segments'] += 1
+
+    def read(self, max_lines: int) -> tuple:
+        """
+        Return (generation, lines) with up to max_lines complete lines from the oldest segment without
+        consuming them, pass both to commit once the lines are written
+        """
+        with self.lock:
+            while self.segments:
+                segment = self.segments[0]
+                active = self.fileh is not None and segment == pathlib.Path(self.fileh.name)
+                if active:
+                    self.fileh.flush()
+                lines = []
+                torn = None
+                with segment.open('rb') as f:
+                    f.seek(self.read_offset)
+                    offset = self.read_offset
+                    for line in f:
+                        if not line.endswith(b'\n'):
+                            torn = offset
+                            break
+                        offset += len(line)
+                        lines.append(line[:-1])
+                        if len(lines) >= max_lines:
+                            break
+                if torn is not None and not active:
+                    # left by a crash mid-append, nothing will ever complete the line
+                    print(f'ERROR: dropping torn line at the end of spool segment {segment.name}', flush=True)
+                    self.size -= segment.stat().st_size - torn
+                    os.truncate(segment, torn)
+                    self.counters['torn_lines'] += 1
+                if lines or active:
+                    return self.generation, lines
+                self._evict()
+            return self.generation, []
+
+    def commit(self, generation: int, lines: list) -> None:
+        """Consume lines previously returned by read once they are safely written"""
+        with self.lock:
+            if not self.segments or generation != self.generation:
+                # the segment was evicted by append while its lines were being replayed
+                return
+            self.read_offset += sum(len(line) + 1 for line in lines)
+            self.counters['replayed'] += len(lines)
+            segment = self.segments[0]
+            if self.read_offset >= segment.stat().st_size:
+                self._evict()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.fileh:
+                self.fileh.close()
+                self.fileh = None
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+            stats['segments'] = len(self.segments)
+            stats['bytes'] = self.size
+        return stats
+
+    def _rotate(self) -> None:
+        if self.fileh:
+            self.fileh.close()
+        seq = int(self.segments[-1].stem) + 1 if self.segments else 0
+        segment = self.path / f'{seq:012d}{self.SUFFIX}'
+        self.segments.append(segment)
+        self.fileh = segment.open('ab')
+
+    def _evict(self) -> None:
+        segment = self.segments.popleft()
+        self.size -= segment.stat().st_size
+        if self.fileh and segment == pathlib.Path(self.fileh.name):
+            self.fileh.close()
+            self.fileh = None
+        segment.unlink()
+        self.read_offset = 0
+        self.generation += 1
+
+
 class InfluxDB():
-    def __init__(self, bucket, hostname='influxdb'):
+    def __init__(self, bucket, hostname='influxdb', batching=False, batch_size=1000, flush_interval=1.0,
+                 max_queue=50000, overflow='drop-oldest', spool_dir=None, spool_max_size=256 * 2**20,
+                 replay_rate=5000):
         self.token = None
         self.org = None
         self.bucket = bucket
@@ -21,6 +446,20 @@ class InfluxDB():
         self.write_api = self.client.write_api(write_options=influxdb_client.client.write_api.SYNCHRONOUS)
         self.query_api = self.client.query_api()
 
+        self.spool = None
+        self.replay_rate = replay_rate
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.closing = threading.Event()
+        if spool_dir:
+            self.spool = Spool(spool_dir, max_size=spool_max_size)
+            self.replayer = threading.Thread(target=self._replay, name='influx-replay', daemon=True)
+            self.replayer.start()
+
+        self.writer = None
+        if batching:
+            self.writer = BatchWriter(self._write_batch, batch_size, flush_interval, max_queue, overflow)
+
     def load_config(self):
         with open('/etc/influxdb2/influx-configs') as f:
             for line in f:
@@ -32,7 +471,92 @@ class InfluxDB():
                     print('Org is: ', self.org, file=sys.stderr)
 
     def write(self, record):
-        self.write_api.write(bucket=self.bucket, record=record)
+        """Write a point dict or raw line protocol bytes (nanosecond timestamps)"""
+        if self.writer:
+            self.writer.put(record)
+        else:
+            self._write_batch([record])
+
+    def _write_batch(self, records: list):
+        if not self.spool:
+            self._write_records(records)
+            return
+
+        lines = [self._to_line(record) for record in records]
+        if self.spool.pending():
+            # keep ordering: nothing new goes straight to the server until the spool is drained
+            self.spool.append(lines)
+            return
+        try:
+            self._write_records(lines)
+        except Exception as e:
+            print(f'ERROR: spooling {len(lines)} lines: {str(e)}', flush=True)
+            self.spool.append(lines)
+
+    def _write_records(self, records: list) -> int:
+        """
+        Write records, bisecting a batch influxdb rejects (4xx) to drop only the offending records.
+        Returns the number dropped, connection errors, 429 and 5xx are raised so the batch can be retried.
+        """
+        try:
+            self.write_api.write(bucket=self.bucket, record=records)
+            return 0
+        except influxdb_client.rest.ApiException as e:
+            if e.status is None or not 400 <= e.status < 500 or e.status == 429:
+                raise
+            if len(records) == 1:
+                print(f'ERROR: influxdb rejected {records[0]!r}: {e.status} {e.body}', flush=True)
+                with self.lock:
+                    self.rejected += 1
+                return 1
+        half = len(records) // 2
+        return self._write_records(records[:half]) + self._write_records(records[half:])
+
+    @staticmethod
+    def _to_line(record) -> bytes:
+        if isinstance(record, bytes):
+            return record
+        if isinstance(record, str):
+            return record.encode()
+        return influxdb_client.Point.from_dict(record, influxdb_client.WritePrecision.NS).to_line_protocol().encode()
+
+    def _replay(self, retry_interval=5.0):
+        """Drain the spool in order once the server accepts writes again, at most replay_rate lines/second"""
+        while not self.closing.is_set():
+            generation, lines = self.spool.read(max(1, self.replay_rate))
+            if not lines:
+                self.closing.wait(retry_interval)
+                continue
+            try:
+                self._write_records(lines)
+            except Exception as e:
+                print(f'ERROR: replay of {len(lines)} spooled lines failed: {str(e)}', flush=True)
+                self.closing.wait(retry_interval)
+                continue
+            self.spool.commit(generation, lines)
+            print(f'Replayed {len(lines)} spooled lines', flush=True)
+            self.closing.wait(len(lines) / self.replay_rate)
+
+    def flush(self, timeout=None):
+        if self.writer:
+            self.writer.flush(timeout)
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+        if self.spool:
+            self.closing.set()
+            self.replayer.join()
+            self.spool.close()
+        self.client.close()
+
+    def stats(self) -> dict:
+        stats = self.writer.stats() if self.writer else {}
+        with self.lock:
+            stats['rejected'] = self.rejected
+        if self.spool:
+            stats.update({f'spool_{k}': v for k, v in self.spool.stats().items()})
+        return stats
 
     def query(self, query):
         return self.query_api.query(org=self.org, query=query)
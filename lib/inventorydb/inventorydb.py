@@ -4,19 +4,156 @@ Python object to work with PostgreSQL object inventory
 Author: Pete Ezzo <peter.ezzo@gmail.com>
 """
 
+import collections
+import threading
+import time
+from typing import Callable, Iterable, Iterator
 import psycopg2  # type: ignore
+from psycopg2.extensions import connection as Connection  # type: ignore
+from psycopg2.extras import execute_values  # type: ignore
+from psycopg2.pool import ThreadedConnectionPool  # type: ignore
+
+
+SEARCH_WINDOW = 2 * 24 * 60 * 60  # searches only return objects seen in the last 2 days
+
+# fixed queries are prepared once per connection and run with EXECUTE
+SEARCHES = {
+    'search_all': "select * from Inventory where name {op} $1 "
+                  "and lastseen > NOW() - interval '2 days' order by name",
+    'search_names': "select distinct name, meta from Inventory where name {op} $1 "
+                    "and lastseen > NOW() - interval '2 days' order by name",
+    'search_all_by_src': "select * from Inventory where src {op} $1 "
+                         "and lastseen > NOW() - interval '2 days' order by name",
+}
+SOURCES_BY_NAME = "select name, array_agg(distinct src) from Inventory where name {op} %s " \
+                  "and lastseen > NOW() - interval '2 days' group by name order by count(distinct src), name"
+STATEMENTS = {
+    'upsert': 'insert into Inventory (src, meta, name) values ($1, $2, $3) '
+              'on conflict (src, meta, name) do update set lastseen = NOW()',
+    **{f'{name}_regex': query.format(op='~*') for name, query in SEARCHES.items()},
+    **{f'{name}_substring': query.format(op='ilike') for name, query in SEARCHES.items()},
+}
+
+
+class PreparingConnection(Connection):
+    """psycopg2 connection that remembers which statements were prepared on it"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        # without a pool every thread shares the connection, two of them must not prepare the same statement
+        self.prepare_lock = threading.Lock()
 
 
 class InventoryDB():
-    def __init__(self, host, dbname, user, password, sslmode='prefer'):
-        conn_string = f'host={host} user={user} dbname={dbname} password={password} sslmode={sslmode}'
-        self.connection = psycopg2.connect(conn_string)
-        self.connection.autocommit = True
-        # self.connection.set_trace_callback(print)  # activate query debugging
-        self.cursor = self.connection.cursor()
+    def __init__(self, host, dbname, user, password, sslmode='prefer', batch_size=500, flush_interval=1.0,
+                 dedup_window=3600, dedup_size=200000, pool_size=0, retries=5, backoff=0.5):
+        self.conn_string = f'host={host} user={user} dbname={dbname} password={password} sslmode={sslmode}'
+        self.lock = threading.Condition()
+
+        # pool_size > 0 gives every operation its own pooled connection, otherwise all share one
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = None
+        self.connection = None
+        if pool_size:
+            self.pool = ThreadedConnectionPool(1, pool_size, self.conn_string, connection_factory=PreparingConnection)
+            self.pool_slots = threading.BoundedSemaphore(pool_size)
+        else:
+            self.connection = self._connect()
+
+        # bulk upserts are coalesced by key and flushed on size or age
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.last_flush = time.monotonic()
+        self.counters = {'records': 0, 'rows': 0, 'statements': 0, 'cache_hits': 0, 'cache_misses': 0,
+                         'reconnects': 0, 'rejected': 0}
+
+        # keys upserted within dedup_window seconds are not written again, so lastseen is only
+        # refreshed at that granularity; it must stay well inside the search window
+        if dedup_window >= SEARCH_WINDOW:
+            raise ValueError(f'dedup_window must be shorter than the {SEARCH_WINDOW}s search window')
+        self.dedup_window = dedup_window
+        self.dedup_size = dedup_size
+        self.recent = collections.OrderedDict()
 
         self.initdb()
 
+    def _connect(self) -> PreparingConnection:
+        connection = psycopg2.connect(self.conn_string, connection_factory=PreparingConnection)
+        connection.autocommit = True
+        # connection.set_trace_callback(print)  # activate query debugging
+        return connection
+
+    def _getconn(self) -> PreparingConnection:
+        if self.pool:
+            self.pool_slots.acquire()
+            try:
+                connection = self.pool.getconn()
+            except Exception:
+                self.pool_slots.release()
+                raise
+            connection.autocommit = True
+            return connection
+        with self.lock:
+            if self.connection is None or self.connection.closed:
+                self.connection = self._connect()
+            return self.connection
+
+    def _putconn(self, connection: PreparingConnection, broken: bool = False) -> None:
+        if self.pool:
+            self.pool.putconn(connection, close=broken)
+            self.pool_slots.release()
+        elif broken:
+            with self.lock:
+                if self.connection is connection:
+                    self.connection = None
+            connection.close()
+
+    def execute(self, operation: Callable):
+        """
+        Run operation(cursor) on a fresh cursor, reconnecting with exponential backoff if the
+        connection drops. Operations are retried from the start, so they must be idempotent.
+        """
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                connection = self._getconn()
+            except psycopg2.OperationalError as e:
+                error = e
+            else:
+                broken = False
+                try:
+                    with connection.cursor() as cursor:
+                        return operation(cursor)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                    broken = True
+                    error = e
+                finally:
+                    self._putconn(connection, broken)
+            if attempt == self.retries:
+                raise error
+            delay = self._retry_wait(error, delay)
+
+    def _retry_wait(self, error: Exception, delay: float) -> float:
+        """Log a failed attempt and sleep for delay seconds, returns the delay before the next attempt"""
+        print(f'ERROR: database connection failed, retrying in {delay}s: {str(error)}', flush=True)
+        with self.lock:
+            self.counters['reconnects'] += 1
+        time.sleep(delay)
+        return min(delay * 2, 30)
+
+    @staticmethod
+    def _prepared(cursor, name: str, params: tuple) -> None:
+        """Execute one of STATEMENTS, preparing it first if this connection has not seen it"""
+        connection = cursor.connection
+        if name not in connection.prepared:
+            with connection.prepare_lock:
+                if name not in connection.prepared:
+                    cursor.execute(f'prepare {name} as {STATEMENTS[name]};')
+                    connection.prepared.add(name)
+        cursor.execute(f'execute {name} ({", ".join(["%s"] * len(params))});', params)
+
     def initdb(self):
         schema = '''create table if not exists Inventory (
                     id serial primary key,
@@ -26,28 +163,208 @@ class InventoryDB():
                     created timestamp NOT NULL DEFAULT NOW(),
                     lastseen timestamp NOT NULL DEFAULT NOW(),
                     unique (src, meta, name));'''
-        self.cursor.execute(schema)
+
+        # trigram indexes serve both the regex (~*) and substring (ilike) searches
+        indexes = '''create extension if not exists pg_trgm;
+                     create index if not exists inventory_name_trgm on Inventory using gin (name gin_trgm_ops);
+                     create index if not exists inventory_src_trgm on Inventory using gin (src gin_trgm_ops);
+                     create index if not exists inventory_lastseen on Inventory (lastseen);'''
+
+        def create(cursor):
+            cursor.execute(schema)
+            cursor.execute(indexes)
+        self.execute(create)
 
     def add_record(self, src, meta, name):
-        query = 'insert into Inventory (src, meta, name) values (%s, %s, %s) ' + \
+        self.execute(lambda cursor: self._prepared(cursor, 'upsert', (src, meta, name)))
+
+    def add_records(self, records: Iterable[tuple]) -> None:
+        """
+        Queue (src, meta, name) records for a bulk upsert, duplicate keys are coalesced in memory
+        and the batch is written once batch_size keys are waiting or flush_interval has passed.
+        Keys already upserted within dedup_window are skipped, malformed records are logged and dropped.
+        """
+        now = time.monotonic()
+        with self.lock:
+            for record in records:
+                key = tuple(record)
+                self.counters['records'] += 1
+                if len(key) != 3 or not all(isinstance(field, str) for field in key):
+                    print(f'ERROR: dropping malformed inventory record {key!r}', flush=True)
+                    self.counters['rejected'] += 1
+                    continue
+                written = self.recent.get(key)
+                if written is not None and now - written < self.dedup_window:
+                    self.counters['cache_hits'] += 1
+                    continue
+                self.counters['cache_misses'] += 1
+                self.pending[key] = None
+            full = len(self.pending) >= self.batch_size
+            if self.pending:
+                self.lock.notify_all()
+        self.flush_records(force=full)
+
+    def wait_flush(self, timeout: float = None) -> bool:
+        """Block until queued records are due for flush_records(force=False), returns False on timeout"""
+        with self.lock:
+            if not self.lock.wait_for(lambda: self.pending, timeout):
+                return False
+            delay = self.last_flush + self.flush_interval - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        return True
+
+    def flush_records(self, force: bool = True) -> int:
+        """Write queued records as one multi-row upsert, returns the number of rows written"""
+        with self.lock:
+            if not force and time.monotonic() - self.last_flush < self.flush_interval:
+                return 0
+            self.last_flush = time.monotonic()
+            if not self.pending:
+                return 0
+            rows = list(self.pending)
+            self.pending.clear()
+
+        query = 'insert into Inventory (src, meta, name) values %s ' + \
                 'on conflict (src, meta, name) do update set lastseen = NOW();'
-        self.cursor.execute(query, (src, meta, name))
-
-    def search_all(self, searchstr):
-        query = "select * from Inventory where name ~* %s " + \
-                "and lastseen > NOW() - interval '2 days' order by name;"
-        return self._search(query, (searchstr,))
-
-    def search_names(self, searchstr):
-        query = "select distinct name, meta from Inventory where name ~* %s " + \
-                "and lastseen > NOW() - interval '2 days' order by name;"
-        return self._search(query, (searchstr,))
-
-    def search_all_by_src(self, searchstr):
-        query = "select * from Inventory where src ~* %s " + \
-                "and lastseen > NOW() - interval '2 days' order by name;"
-        return self._search(query, (searchstr,))
-
-    def _search(self, query: str, params: tuple):
-        self.cursor.execute(query, (params))
-        return self.cursor.fetchall()
+        try:
+            self.execute(lambda cursor: execute_values(cursor, query, rows, page_size=len(rows)))
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # the database is unreachable, keep the batch for the next flush
+            with self.lock:
+                self.pending.update(dict.fromkeys(rows))
+            raise
+        except psycopg2.Error as e:
+            print(f'ERROR: bulk upsert of {len(rows)} rows failed, retrying row by row: {str(e)}', flush=True)
+            return self._flush_rows(rows)
+        with self.lock:
+            self.counters['rows'] += len(rows)
+            self.counters['statements'] += 1
+            self._remember(rows)
+        return len(rows)
+
+    def _flush_rows(self, rows: list) -> int:
+        """Upsert rows one at a time so a row the database rejects only loses itself"""
+        written = []
+        try:
+            for i, row in enumerate(rows):
+                try:
+                    self.execute(lambda cursor: self._prepared(cursor, 'upsert', row))
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    with self.lock:
+                        self.pending.update(dict.fromkeys(rows[i:]))
+                    raise
+                except psycopg2.Error as e:
+                    print(f'ERROR: dropping inventory record {row!r}: {str(e)}', flush=True)
+                    with self.lock:
+                        self.counters['rejected'] += 1
+                    continue
+                written.append(row)
+        finally:
+            with self.lock:
+                self.counters['rows'] += len(written)
+                self.counters['statements'] += len(written)
+                self._remember(written)
+        return len(written)
+
+    def _remember(self, rows: list) -> None:
+        """Record keys as freshly upserted, oldest writes are evicted first"""
+        now = time.monotonic()
+        for key in rows:
+            self.recent[key] = now
+            self.recent.move_to_end(key)
+        while len(self.recent) > self.dedup_size:
+            self.recent.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+            stats['pending'] = len(self.pending)
+            stats['cached_keys'] = len(self.recent)
+        return stats
+
+    def search_all(self, searchstr, substring=False):
+        return self._search('search_all', searchstr, substring)
+
+    def search_names(self, searchstr, substring=False):
+        return self._search('search_names', searchstr, substring)
+
+    def search_all_by_src(self, searchstr, substring=False):
+        return self._search('search_all_by_src', searchstr, substring)
+
+    @staticmethod
+    def _pattern(searchstr: str, substring: bool) -> str:
+        if not substring:
+            return searchstr
+        escaped = searchstr.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return f'%{escaped}%'
+
+    def iter_search_all(self, searchstr, substring=False, itersize=2000) -> Iterator[tuple]:
+        return self._stream(SEARCHES['search_all'], searchstr, substring, itersize)
+
+    def iter_search_names(self, searchstr, substring=False, itersize=2000) -> Iterator[tuple]:
+        return self._stream(SEARCHES['search_names'], searchstr, substring, itersize)
+
+    def iter_search_all_by_src(self, searchstr, substring=False, itersize=2000) -> Iterator[tuple]:
+        return self._stream(SEARCHES['search_all_by_src'], searchstr, substring, itersize)
+
+    def iter_sources_by_name(self, searchstr, substring=False, itersize=2000) -> Iterator[tuple]:
+        """Yield (name, [src, ...]) for matching objects, names with the fewest sources first"""
+        return self._stream(SOURCES_BY_NAME, searchstr, substring, itersize)
+
+    def _stream(self, query: str, searchstr: str, substring: bool, itersize: int) -> Iterator[tuple]:
+        """
+        Yield rows from a server-side cursor, fetching itersize rows per round trip. The cursor needs
+        a transaction, so it runs on its own pooled connection (or a dedicated one without a pool).
+        Connecting and the first fetch are retried with backoff like execute(). Once rows have been
+        yielded a lost connection raises, as retrying would repeat them.
+        """
+        query = query.format(op='ilike' if substring else '~*').replace('$1', '%s') + ';'
+        params = (self._pattern(searchstr, substring),)
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                connection = self._getconn() if self.pool else psycopg2.connect(self.conn_string)
+            except psycopg2.OperationalError as e:
+                error = e
+            else:
+                cursor = None
+                broken = False
+                try:
+                    connection.autocommit = False
+                    cursor = connection.cursor(name=f'inventory_stream_{id(connection)}')
+                    cursor.itersize = itersize
+                    try:
+                        cursor.execute(query, params)
+                        rows = cursor.fetchmany(itersize)
+                    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                        broken = True
+                        error = e
+                    else:
+                        yield from rows
+                        yield from cursor
+                        return
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    broken = True
+                    raise
+                finally:
+                    if cursor is not None and not broken and not connection.closed:
+                        cursor.close()
+                    if not self.pool:
+                        connection.close()
+                    else:
+                        if not broken and not connection.closed:
+                            connection.rollback()
+                        self._putconn(connection, broken)
+            if attempt == self.retries:
+                raise error
+            delay = self._retry_wait(error, delay)
+
+    def _search(self, search: str, searchstr: str, substring: bool):
+        name = f'{search}_substring' if substring else f'{search}_regex'
+        params = (self._pattern(searchstr, substring),)
+
+        def fetch(cursor):
+            self._prepared(cursor, name, params)
+            return cursor.fetchall()
+        return self.execute(fetch)
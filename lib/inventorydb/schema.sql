@@ -7,3 +7,8 @@ create table if not exists Inventory (
     lastseen timestamp NOT NULL DEFAULT NOW(),
     unique (src, meta, name)
 );
+
+create extension if not exists pg_trgm;
+create index if not exists inventory_name_trgm on Inventory using gin (name gin_trgm_ops);
+create index if not exists inventory_src_trgm on Inventory using gin (src gin_trgm_ops);
+create index if not exists inventory_lastseen on Inventory (lastseen);
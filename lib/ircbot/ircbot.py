@@ -7,16 +7,133 @@ Copyright (c) 2009 Ferry Boender
 Copyright (c) 1999-2002 Joel Rosdahl
 """
 
+import heapq
+import itertools
+import json
+import re
+import selectors
 import ssl
 import socket
+import threading
+import time
 import socks
 from typing import Callable, Tuple
-from irc.client import Reactor, Connection, DCCConnectionError, Event, ServerConnection  # type: ignore
+import irc.client  # type: ignore
+from irc.client import Connection, DCCConnectionError, Event, ServerConnection  # type: ignore
 from jaraco.stream import buffer  # type: ignore
 
 ServerConnection.buffer_class = buffer.LenientDecodingLineBuffer
 
 
+class Reactor(irc.client.Reactor):
+    """
+    Reactor that leaves paused and throttled connections out of the select set, so a DCC receiver
+    can stop reading until it has room for more data or bandwidth to spare
+
+    run_forever() is an event-driven alternative to process_forever(): it blocks in a selector until
+    a socket is readable, a timer or throttle is due, or another thread calls wakeup(), instead of
+    polling with a fixed timeout.
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.selector = selectors.DefaultSelector()
+        self.registered = set()
+        self.timers = []
+        self.timer_lock = threading.Lock()
+        self.timer_seq = itertools.count()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ)
+
+    @property
+    def sockets(self):
+        with self.mutex:
+            return [
+                conn.socket
+                for conn in self.connections
+                if conn is not None and conn.socket is not None and getattr(conn, 'reading', True)
+            ]
+
+    def wakeup(self) -> None:
+        """Interrupt the selector wait, safe to call from any thread"""
+        try:
+            self._wakeup_w.send(b'\0')
+        except OSError:  # a full buffer already guarantees a wakeup
+            pass
+
+    def call_later(self, delay: float, callback: Callable, period: float = None) -> None:
+        """Run callback() on the reactor thread after delay seconds, then every period seconds if given"""
+        with self.timer_lock:
+            heapq.heappush(self.timers, (time.monotonic() + delay, next(self.timer_seq), period, callback))
+        self.wakeup()
+
+    def call_every(self, period: float, callback: Callable) -> None:
+        self.call_later(period, callback, period)
+
+    def _run_timers(self) -> None:
+        now = time.monotonic()
+        due = []
+        with self.timer_lock:
+            while self.timers and self.timers[0][0] <= now:
+                when, _, period, callback = heapq.heappop(self.timers)
+                due.append(callback)
+                if period:
+                    heapq.heappush(self.timers, (max(when + period, now), next(self.timer_seq), period, callback))
+        for callback in due:
+            callback()
+
+    def _next_timeout(self, timeout: float = None) -> float | None:
+        """Seconds until the next timer or throttled connection is due, None to wait for I/O only"""
+        deadlines = []
+        with self.timer_lock:
+            if self.timers:
+                deadlines.append(self.timers[0][0])
+        with self.mutex:
+            deadlines.extend(conn.throttled_until for conn in self.connections
+                             if getattr(conn, 'throttled', False) and not conn.paused)
+        wait = max(0., min(deadlines) - time.monotonic()) if deadlines else None
+        if getattr(self.scheduler, 'queue', None):
+            # commands on the irc library scheduler have no cheap deadline, check them every second
+            wait = 1. if wait is None else min(wait, 1.)
+        if timeout is not None:
+            wait = timeout if wait is None else min(wait, timeout)
+        return wait
+
+    def _sync_selector(self) -> None:
+        current = set(self.sockets)
+        for sock in self.registered - current:
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+        for sock in current - self.registered:
+            self.selector.register(sock, selectors.EVENT_READ)
+        self.registered = current
+
+    def run_once(self, timeout: float = None) -> None:
+        """Wait for one round of socket, timer or wakeup events, at most timeout seconds if given"""
+        self._sync_selector()
+        readable = []
+        for key, _ in self.selector.select(self._next_timeout(timeout)):
+            if key.fileobj is self._wakeup_r:
+                try:
+                    while self._wakeup_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            else:
+                readable.append(key.fileobj)
+        if readable:
+            self.process_data(readable)
+        self._run_timers()
+        self.process_timeout()
+
+    def run_forever(self) -> None:
+        while True:
+            self.run_once()
+
+
 def identity(x):
     return x
 
@@ -57,6 +174,11 @@ class DCCConnection(Connection):
     passive = False
     peeraddress = None
     peerport = None
+    receiver = None
+    buffers = None
+    paused = False
+    throttled_until = 0.
+    _spare = None
 
     def __init__(self, reactor: Reactor, dcctype: str, proxy: Tuple[str, int] | None = None):
         super().__init__(reactor)
@@ -98,8 +220,93 @@ class DCCConnection(Connection):
         )
         self.reactor._remove_connection(self)
 
+    def receive_into(self, receiver: Callable, bufsize: int = 2**18, drained: Callable = None,
+                     max_reads: int = 16, buffers: Callable = None) -> None:
+        """
+        Switch to bulk receive mode: data is read with recv_into into one reusable buffer and handed to
+        receiver(connection, view) directly instead of being routed as dccmsg events.
+        The memoryview is only valid until the receiver returns, unless buffers is given.
+
+        While reads fill the whole buffer up to max_reads are drained per reactor tick without
+        blocking, then drained(connection) is called once, e.g. to send a single coalesced ACK.
+
+        If buffers is given it is called for a fresh memoryview before every read and the receiver
+        owns the filled view. When it returns None the connection pauses until resume() is called.
+        """
+        self.receiver = receiver
+        self.drained = drained
+        self.max_reads = max_reads
+        self.buffers = buffers
+        self._view = None if buffers else memoryview(bytearray(bufsize))
+        try:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, bufsize)
+        except socket.error:
+            pass
+
+    def pause(self) -> None:
+        self.paused = True
+
+    def resume(self) -> None:
+        """Read again, may be called from any thread"""
+        self.paused = False
+        self.reactor.wakeup()
+
+    def throttle(self, seconds: float) -> None:
+        """Stop reading for seconds, used for bandwidth limits"""
+        self.throttled_until = max(self.throttled_until, time.monotonic() + seconds)
+
+    @property
+    def throttled(self) -> bool:
+        return self.throttled_until > time.monotonic()
+
+    @property
+    def reading(self) -> bool:
+        return not self.paused and not self.throttled
+
+    def _next_buffer(self):
+        if not self.buffers:
+            return self._view
+        if self._spare is not None:
+            view, self._spare = self._spare, None
+            return view
+        view = self.buffers()
+        if view is None:
+            # pause first, then look again so a buffer freed in between is not missed
+            self.pause()
+            view = self.buffers()
+            if view is not None:
+                self.resume()
+        return view
+
+    def _process_bulk(self):
+        flags = 0
+        for _ in range(self.max_reads):
+            view = self._next_buffer()
+            if view is None:
+                break
+            try:
+                nbytes = self.socket.recv_into(view, 0, flags)
+            except BlockingIOError:
+                self._spare = view  # nothing was read, keep the buffer for the next tick
+                break
+            except socket.error:
+                self.disconnect("Connection reset by peer")
+                return
+            if not nbytes:
+                self.disconnect("Connection reset by peer")
+                return
+            self.receiver(self, view[:nbytes])
+            if nbytes < len(view) or not self.connected or self.throttled:
+                break
+            flags = socket.MSG_DONTWAIT
+        if self.drained and self.connected:
+            self.drained(self)
+
     def process_data(self):
         """[Internal]"""
+        if self.receiver:
+            self._process_bulk()
+            return
         try:
             new_data = self.socket.recv(2**14)
         except socket.error:
@@ -127,6 +334,54 @@ class DCCConnection(Connection):
             self.disconnect("Connection reset by peer.")
 
 
+class WatchlistMatcher():
+    """
+    Per-channel announcement patterns, compiled once. Each pattern may name a literal that every match
+    contains, lines without it are rejected before the regex runs. Patterns capture meta and name, as
+    named groups or as the first two groups.
+    """
+    # "#1 12x [1.2G] name" style pack announcements
+    DEFAULT = {'pattern': r'.{4,16} +\d+x \[([^\]]+)\] (.*)', 'contains': 'x ['}
+
+    def __init__(self, channels: list, patterns: dict = None) -> None:
+        default = [self.compile(self.DEFAULT)]
+        self.rules = {channel: default for channel in channels if channel}
+        for channel, specs in (patterns or {}).items():
+            specs = specs if isinstance(specs, list) else [specs]
+            self.rules[channel] = [self.compile(spec) for spec in specs]
+        self.channels = frozenset(self.rules)
+
+    @classmethod
+    def from_config(cls, channels: list, path: str = None):
+        """Load per-channel patterns from a JSON file of {channel: pattern, spec or [specs]}"""
+        patterns = None
+        if path:
+            with open(path) as fileh:
+                patterns = json.load(fileh)
+        return cls(channels, patterns)
+
+    @staticmethod
+    def compile(spec) -> tuple:
+        if isinstance(spec, str):
+            spec = {'pattern': spec}
+        regex = re.compile(spec['pattern'])
+        groups = (regex.groupindex.get('meta', 1), regex.groupindex.get('name', 2))
+        return spec.get('contains'), regex, groups
+
+    def match(self, channel: str, line: str) -> Tuple[str, str] | None:
+        """Returns (meta, name) from the first pattern of the channel that matches line"""
+        rules = self.rules.get(channel)
+        if rules is None:
+            return None
+        for contains, regex, groups in rules:
+            if contains and contains not in line:
+                continue
+            extract = regex.match(line)
+            if extract:
+                return extract.group(*groups)
+        return None
+
+
 class IRCBot():
     def __init__(self,
                  host: str,
@@ -155,7 +410,7 @@ class IRCBot():
         print('Connecting to IRC', flush=True)
         self.connection.connect(**self.connstring)
         print('Connected to IRC', flush=True)
-        self.reactor.process_forever(timeout=0.01)
+        self.reactor.run_forever()
 
     def stop(self) -> None:
         self.connection.disconnect('bye')
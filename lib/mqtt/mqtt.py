@@ -2,14 +2,26 @@
 Python object to work with MQTT Broker (tested with Mosquitto)
 """
 
+import asyncio
 import pathlib
+import queue
+import struct
+import threading
 import time
+import traceback
 from functools import wraps
 from typing import Any, Callable, Iterable
-from paho.mqtt.client import Client, MQTTMessage  # type: ignore
+from paho.mqtt.client import Client, MQTTMessage, MQTT_ERR_SUCCESS, MQTT_ERR_NO_CONN  # type: ignore
+
+try:
+    import msgpack  # type: ignore
+except ImportError:
+    msgpack = None
 
 
 HEALTHCHECK = pathlib.Path('/dev/shm/mqtt_healthcheck')
+RECORD_LENGTH = struct.Struct('!H')
+FRAMINGS = ('length', 'msgpack', 'nul')
 
 
 def healthcheck(fn: Callable) -> Callable:
@@ -20,6 +32,263 @@ def healthcheck(fn: Callable) -> Callable:
     return wrapper
 
 
+def pack_records(records: list, framing: str = 'length') -> bytes:
+    """
+    Frame records (sequences of str) into one payload, either each NUL-joined record preceded by its
+    16-bit big-endian length, or a msgpack array of arrays
+    """
+    if framing == 'msgpack':
+        return msgpack.packb([list(record) for record in records])
+    payload = bytearray()
+    for record in records:
+        data = '\x00'.join(record).encode()
+        payload += RECORD_LENGTH.pack(len(data))
+        payload += data
+    return bytes(payload)
+
+
+def unpack_records(payload: bytes, framing: str = 'length') -> list:
+    """Inverse of pack_records, framing 'nul' is a single NUL-joined record"""
+    if framing not in FRAMINGS:
+        raise ValueError(f'Unknown framing {framing}, expected one of {FRAMINGS}')
+    if framing == 'msgpack':
+        return [tuple(record) for record in msgpack.unpackb(payload)]
+    if framing == 'nul':
+        return [tuple(field.decode() for field in payload.split(b'\x00'))]
+    records = []
+    offset = 0
+    while offset < len(payload):
+        length, = RECORD_LENGTH.unpack_from(payload, offset)
+        offset += RECORD_LENGTH.size
+        records.append(tuple(payload[offset:offset + length].decode().split('\x00')))
+        offset += length
+    return records
+
+
+class BatchPublisher():
+    """
+    Collect records for up to window seconds (or max_records) and publish them as one framed message,
+    so a burst of records costs one publish instead of one QoS 2 handshake each
+    """
+    def __init__(self, mqtt, topic: str, window: float = 0.5, max_records: int = 500, framing: str = 'length',
+                 qos: int = 1) -> None:
+        if framing not in ('length', 'msgpack'):
+            raise ValueError(f'Batches are framed with length or msgpack, not {framing}')
+        if framing == 'msgpack' and msgpack is None:
+            raise ImportError('msgpack framing needs the msgpack package')
+        self.mqtt = mqtt
+        self.topic = topic
+        self.window = window
+        self.max_records = max_records
+        self.framing = framing
+        self.qos = qos
+        self.records = []
+        self.stopped = False
+        self.counters = {'records': 0, 'messages': 0}
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name=f'mqtt-batch-{topic}', daemon=True)
+        self.thread.start()
+
+    def add(self, record: tuple) -> None:
+        with self.cond:
+            self.records.append(record)
+            if len(self.records) == 1 or len(self.records) >= self.max_records:
+                self.cond.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self.cond:
+                while not self.records and not self.stopped:
+                    self.cond.wait()
+                deadline = time.monotonic() + self.window
+                while len(self.records) < self.max_records and not self.stopped:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                records, self.records = self.records, []
+                if not records:
+                    return
+            try:
+                self.mqtt.pub(self.topic, pack_records(records, self.framing), self.qos)
+                self.counters['records'] += len(records)
+                self.counters['messages'] += 1
+            except Exception:
+                traceback.print_exc()
+
+    def stop(self) -> None:
+        """Publish what is pending and stop"""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join()
+
+    def stats(self) -> dict:
+        stats = dict(self.counters)
+        stats['records_per_message'] = stats['records'] / stats['messages'] if stats['messages'] else 0.0
+        return stats
+
+
+class Dispatcher():
+    """
+    Run a subscription callback on worker threads fed by bounded queues instead of the paho network thread
+
+    With ordered=True each worker owns a queue and messages are assigned to a worker by topic,
+    so messages on the same topic are handled in arrival order. Otherwise all workers share one queue.
+    A full queue stalls the network thread until a worker makes room, so no message is lost and the
+    broker sees the backpressure. With block=False a full queue drops the message and counts it instead.
+    """
+    def __init__(self, name: str, callback: Callable, workers: int = 1, queue_size: int = 1000,
+                 ordered: bool = True, block: bool = True) -> None:
+        self.name = name
+        self.callback = callback
+        self.block = block
+        self.queues = [queue.Queue(queue_size) for _ in range(workers if ordered else 1)]
+        self.lock = threading.Lock()
+        self.counters = {
+            'handled': 0,
+            'dropped': 0,
+            'errors': 0,
+            'last_latency': 0.0,
+            'max_latency': 0.0,
+            'total_latency': 0.0,
+        }
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, args=(self.queues[i % len(self.queues)],),
+                                      name=f'mqtt-dispatch-{name}-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def __call__(self, client: Client, userdata: Any, msg: MQTTMessage) -> None:
+        """Paho callback, queue the message for a worker"""
+        self.submit(msg.topic, client, userdata, msg)
+
+    def submit(self, topic: str, *args, **kwargs) -> None:
+        """Queue a callback invocation, ordered by topic"""
+        q = self.queues[hash(topic) % len(self.queues)] if len(self.queues) > 1 else self.queues[0]
+        try:
+            q.put((args, kwargs), block=self.block)
+        except queue.Full:
+            with self.lock:
+                self.counters['dropped'] += 1
+            print(f'Dispatch queue for {self.name} full, dropped message on {topic}', flush=True)
+
+    def _work(self, q: queue.Queue) -> None:
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            start = time.monotonic()
+            try:
+                self.callback(*item[0], **item[1])
+                error = False
+            except Exception:
+                traceback.print_exc()
+                error = True
+            latency = time.monotonic() - start
+            with self.lock:
+                self.counters['handled'] += 1
+                self.counters['errors'] += error
+                self.counters['last_latency'] = latency
+                self.counters['total_latency'] += latency
+                if latency > self.counters['max_latency']:
+                    self.counters['max_latency'] = latency
+
+    def stop(self) -> None:
+        for i in range(len(self.threads)):
+            self.queues[i % len(self.queues)].put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+        total_latency = stats.pop('total_latency')
+        stats['avg_latency'] = total_latency / stats['handled'] if stats['handled'] else 0.0
+        stats['queue_depth'] = sum(q.qsize() for q in self.queues)
+        return stats
+
+
+class TopicRouter():
+    """
+    Match topics against MQTT subscription patterns compiled into a trie
+
+    Patterns use the MQTT wildcards + and #, plus {name} as a named single level wildcard,
+    e.g. Sensors/{location}/{metric}. match() splits the topic once and walks the trie,
+    returning every handler whose pattern matches along with the named captures.
+    """
+    class Node():
+        __slots__ = ('children', 'handlers')
+
+        def __init__(self) -> None:
+            self.children = {}
+            self.handlers = []
+
+    def __init__(self) -> None:
+        self.root = self.Node()
+
+    @staticmethod
+    def subscription(pattern: str) -> str:
+        """The MQTT topic filter to subscribe to for a pattern"""
+        return '/'.join('+' if level.startswith('{') and level.endswith('}') else level
+                        for level in pattern.split('/'))
+
+    @staticmethod
+    def covers(topic_filter: str, other: str) -> bool:
+        """Whether every topic matching the filter other also matches topic_filter"""
+        levels, others = topic_filter.split('/'), other.split('/')
+        for i, level in enumerate(levels):
+            if level == '#':
+                return True
+            if i == len(others) or others[i] == '#' or (level != '+' and level != others[i]):
+                return False
+        return len(levels) == len(others)
+
+    def add(self, pattern: str, handler: Callable) -> None:
+        node = self.root
+        names = []
+        levels = pattern.split('/')
+        for i, level in enumerate(levels):
+            if level == '#' and i != len(levels) - 1:
+                raise ValueError(f'# must be the last level of {pattern}')
+            if level == '+':
+                names.append(None)
+            elif level.startswith('{') and level.endswith('}'):
+                names.append(level[1:-1])
+                level = '+'
+            node = node.children.setdefault(level, self.Node())
+        node.handlers.append((handler, tuple(names)))
+
+    def match(self, topic: str) -> list:
+        """Return (handler, captures) for every pattern matching topic"""
+        levels = topic.split('/')
+        depth_max = len(levels)
+        matches = []
+        stack = [(self.root, 0, ())]
+        while stack:
+            node, depth, values = stack.pop()
+            children = node.children
+            tail = children.get('#')
+            if tail:
+                matches.extend(self._captures(tail.handlers, values))
+            if depth == depth_max:
+                matches.extend(self._captures(node.handlers, values))
+                continue
+            level = levels[depth]
+            child = children.get(level)
+            if child:
+                stack.append((child, depth + 1, values))
+            child = children.get('+')
+            if child:
+                stack.append((child, depth + 1, values + (level,)))
+        return matches
+
+    @staticmethod
+    def _captures(handlers: list, values: tuple) -> list:
+        return [(handler, {name: value for name, value in zip(names, values) if name}) for handler, names in handlers]
+
+
 class MQTT():
     def __init__(self,
                  host: str,
@@ -28,7 +297,8 @@ class MQTT():
                  password: str = None,
                  keepalive: int = 60,
                  client_id: str = None,
-                 use_ssl: bool = False
+                 use_ssl: bool = False,
+                 workers: int = 0
                  ) -> None:
 
         self.host = host
@@ -36,6 +306,13 @@ class MQTT():
         self.keepalive = keepalive
         self.client_id = client_id
         self.client = Client(client_id)
+        self.workers = workers
+        self.dispatchers = {}
+        self.router = TopicRouter()
+        self.router.add('Commands/ALL', self.check_in)
+        self.fallbacks = TopicRouter()
+        self.route_filters = {}  # topic filter of every route: highest qos asked for it
+        self.subscriptions = {}  # topic filter subscribed at the broker: qos
 
         if use_ssl:
             self.client.tls_set()
@@ -51,7 +328,11 @@ class MQTT():
     @healthcheck
     def on_message(self, client: Client, userdata: Any, msg: MQTTMessage) -> None:
         print(f'Msg: {msg.topic} {str(msg.qos)} {str(msg.payload)}')
-        if msg.topic == 'Commands/ALL' and msg.payload == b'check-in':
+        for handler, captures in self.router.match(msg.topic) or self.fallbacks.match(msg.topic):
+            handler(msg, **captures)
+
+    def check_in(self, msg: MQTTMessage) -> None:
+        if msg.payload == b'check-in':
             self.pub('Notifications/check-in-reply', self.client_id, qos=1)
 
     @healthcheck
@@ -70,11 +351,76 @@ class MQTT():
             print('PUBLISH', topic, message, flush=True)
 
     @healthcheck
-    def sub(self, callback: Callable, topic: str, qos: int = 2) -> None:
+    def sub(self, callback: Callable, topic: str, qos: int = 2, workers: int = None, ordered: bool = True,
+            queue_size: int = 1000, block: bool = True) -> None:
+        """
+        Subscribe to a topic, callbacks run on the network thread unless workers (or the client default) is set
+
+        Subscribing to the same topic again replaces its callback, and stops the workers of the old one once
+        they have handled what is queued. block=False drops messages while the worker queue is full.
+        """
+        workers = self.workers if workers is None else workers
+        previous = self.dispatchers.pop(topic, None) if callback else None
+        if callback and workers:
+            callback = Dispatcher(topic, healthcheck(callback), workers, queue_size, ordered, block)
+            self.dispatchers[topic] = callback
         if callback:
             self.client.message_callback_add(topic, healthcheck(callback))
+        if previous:
+            previous.stop()
         self.client.subscribe(topic, qos)
 
+    @healthcheck
+    def route(self, pattern: str, callback: Callable, qos: int = 2, workers: int = None, ordered: bool = True,
+              queue_size: int = 1000, block: bool = True, fallback: bool = False) -> None:
+        """
+        Subscribe to a topic pattern such as Sensors/{location}/{metric}, callback(msg, **captures)
+        receives the named levels already parsed
+
+        A fallback route only receives the messages no other route matched, e.g. Commands/IRC/# to answer
+        unknown commands. Only the widest of overlapping route filters is subscribed, at the highest qos of
+        the filters it covers, so the broker does not deliver a message once per overlapping filter.
+
+        With workers, block=False drops messages while the worker queue is full. Each pattern can have one
+        dispatched route, as every route added for a pattern stays registered.
+        """
+        workers = self.workers if workers is None else workers
+        router = self.fallbacks if fallback else self.router
+        if workers:
+            if pattern in self.dispatchers:
+                raise ValueError(f'{pattern} already has a dispatched route')
+            dispatcher = Dispatcher(pattern, healthcheck(callback), workers, queue_size, ordered, block)
+            self.dispatchers[pattern] = dispatcher
+
+            def routed(msg, **captures):
+                dispatcher.submit(msg.topic, msg, **captures)
+            router.add(pattern, routed)
+        else:
+            router.add(pattern, callback)
+
+        topic_filter = TopicRouter.subscription(pattern)
+        self.route_filters[topic_filter] = max(qos, self.route_filters.get(topic_filter, 0))
+        self._resubscribe()
+
+    def _resubscribe(self) -> None:
+        """Subscribe to the route filters no other one covers before unsubscribing the covered ones"""
+        filters = self.route_filters
+        wanted = {}
+        for topic_filter in filters:
+            if not any(other != topic_filter and TopicRouter.covers(other, topic_filter) for other in filters):
+                wanted[topic_filter] = max(qos for other, qos in filters.items()
+                                           if TopicRouter.covers(topic_filter, other))
+        for topic_filter, qos in wanted.items():
+            if self.subscriptions.get(topic_filter) != qos:
+                self.client.subscribe(topic_filter, qos)
+        for topic_filter in self.subscriptions.keys() - wanted.keys():
+            self.client.unsubscribe(topic_filter)
+        self.subscriptions = wanted
+
+    def dispatch_stats(self) -> dict:
+        """Queue depth and handler latency of every dispatched subscription"""
+        return {topic: dispatcher.stats() for topic, dispatcher in self.dispatchers.items()}
+
     @healthcheck
     def multipub(self, msgs: Iterable, verbose: bool = False) -> None:
         for msg in msgs:
@@ -94,3 +440,213 @@ class MQTT():
 
     def stop(self) -> None:
         self.client.disconnect()
+        for dispatcher in self.dispatchers.values():
+            dispatcher.stop()
+
+
+class Subscription():
+    """Async iterator over (message, captures) for one AsyncMQTT.subscribe() pattern"""
+    def __init__(self, mqtt, pattern: str, maxsize: int) -> None:
+        self.mqtt = mqtt
+        self.pattern = pattern
+        self.maxsize = maxsize
+        self.queue = asyncio.Queue()
+
+    @property
+    def full(self) -> bool:
+        return bool(self.maxsize) and self.queue.qsize() >= self.maxsize
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> tuple:
+        item = await self.queue.get()
+        if item is None:
+            raise StopAsyncIteration
+        self.mqtt._update_reading()
+        return item
+
+
+class AsyncMQTT():
+    """
+    asyncio variant of MQTT: paho's socket is driven by the event loop instead of a network thread
+
+    publish() waits for the broker to acknowledge the message (PUBACK/PUBCOMP, or the socket write
+    for QoS 0). subscribe() returns an async iterator of (msg, captures); while any subscriber has
+    maxsize messages waiting the client stops reading from the broker, so a slow consumer pushes back
+    through TCP instead of growing a queue (except while a publish() waits for its ack or a keepalive
+    ping waits for its response). Check-in, startup notification and healthcheck behave as in MQTT.
+    """
+    def __init__(self,
+                 host: str,
+                 port: int = 1883,
+                 user: str = None,
+                 password: str = None,
+                 keepalive: int = 60,
+                 client_id: str = None,
+                 use_ssl: bool = False,
+                 reconnect_delay: float = 1.0
+                 ) -> None:
+
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.client_id = client_id
+        self.reconnect_delay = reconnect_delay
+        self.client = Client(client_id)
+        self.router = TopicRouter()
+        self.subscriptions = []
+        self.acks = {}  # mid: future
+        self._qos = {}  # subscription: qos
+        self.loop = None
+        self.reading = False
+        self.stopped = False
+        self.connected = None
+        self._misc = None
+
+        if use_ssl:
+            self.client.tls_set()
+            self.client.tls_insecure_set(True)
+
+        if user or password:
+            self.client.username_pw_set(user, password)
+
+        self.client.on_message = self.on_message
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_publish = self.on_publish
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    async def listen(self) -> None:
+        """Connect and wait for the CONNACK, the connection is kept up until stop()"""
+        self.loop = asyncio.get_running_loop()
+        self.connected = asyncio.Event()
+        self.stopped = False
+        self.client.connect(self.host, self.port, self.keepalive)
+        await self.connected.wait()
+
+    async def stop(self) -> None:
+        self.stopped = True
+        self.client.disconnect()
+        for subscription in self.subscriptions:
+            subscription.queue.put_nowait(None)
+        for future in self.acks.values():
+            future.cancel()
+        self.acks.clear()
+
+    @healthcheck
+    def on_connect(self, client: Client, userdata: Any, flags: dict, rc: int) -> None:
+        print(f'Connected to {client._host}:{client._port} code {rc}')
+        client.subscribe('Commands/ALL', 1)
+        for subscription in self.subscriptions:
+            client.subscribe(self.router.subscription(subscription.pattern), self._qos[subscription])
+        client.publish('Notifications/startup', f'{self.client_id} connect at {time.time()}', 1)
+        self.connected.set()
+
+    def on_disconnect(self, client: Client, userdata: Any, rc: int) -> None:
+        print(f'Disconnected from {client._host}:{client._port} code {rc}')
+        self.connected.clear()
+        if not self.stopped:
+            self.loop.create_task(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        delay = self.reconnect_delay
+        while not self.stopped:
+            await asyncio.sleep(delay)
+            try:
+                self.client.reconnect()
+                return
+            except OSError as e:
+                print(f'Reconnect to {self.host}:{self.port} failed: {e}', flush=True)
+                delay = min(delay * 2, 60)
+
+    @healthcheck
+    def on_message(self, client: Client, userdata: Any, msg: MQTTMessage) -> None:
+        print(f'Msg: {msg.topic} {str(msg.qos)} {str(msg.payload)}')
+        if msg.topic == 'Commands/ALL' and msg.payload == b'check-in':
+            self.client.publish('Notifications/check-in-reply', self.client_id, 1)
+        for subscription, captures in self.router.match(msg.topic):
+            subscription.queue.put_nowait((msg, captures))
+        self._update_reading()
+
+    def on_publish(self, client: Client, userdata: Any, mid: int) -> None:
+        future = self.acks.pop(mid, None)
+        if future and not future.done():
+            future.set_result(mid)
+        if not self.acks:
+            self._update_reading()
+
+    async def publish(self, topic: str, message, qos: int = 2, retain: bool = False, verbose: bool = False) -> int:
+        """Publish and wait until the broker has the message, returns the message id"""
+        HEALTHCHECK.touch()
+        info = self.client.publish(topic, message, qos, retain)
+        if verbose:
+            print('PUBLISH', topic, message, flush=True)
+        if info.rc not in (MQTT_ERR_SUCCESS, MQTT_ERR_NO_CONN) or (info.rc == MQTT_ERR_NO_CONN and not qos):
+            raise ConnectionError(f'Publish to {topic} failed with code {info.rc}')
+        if info.is_published():
+            return info.mid
+        future = self.loop.create_future()
+        self.acks[info.mid] = future
+        self._update_reading()
+        return await future
+
+    def subscribe(self, pattern: str, qos: int = 2, maxsize: int = 1000) -> Subscription:
+        """
+        Subscribe to a topic pattern (MQTT wildcards or {name} levels), iterate the result with
+        async for msg, captures in ..., captures holds the named levels. Iteration ends after stop().
+        """
+        subscription = Subscription(self, pattern, maxsize)
+        self.subscriptions.append(subscription)
+        self._qos[subscription] = qos
+        self.router.add(pattern, subscription)
+        self.client.subscribe(self.router.subscription(pattern), qos)
+        return subscription
+
+    def _update_reading(self) -> None:
+        """
+        Stop reading from the broker while a subscriber is full, start again once it has drained.
+        Acks and PINGRESP arrive on the same socket, so reading carries on while a publish() is waiting
+        for its ack or a keepalive ping for its response, otherwise paho drops the connection.
+        """
+        sock = self.client.socket()
+        if sock is None:
+            return
+        # paho has no public way to tell whether a PINGREQ is outstanding, _ping_t is why requirements.txt
+        # holds paho-mqtt below 2.0
+        waiting = self.acks or self.client._ping_t
+        full = not waiting and any(subscription.full for subscription in self.subscriptions)
+        if full and self.reading:
+            self.loop.remove_reader(sock)
+            self.reading = False
+        elif not full and not self.reading:
+            self.loop.add_reader(sock, self.client.loop_read)
+            self.reading = True
+
+    def on_socket_open(self, client: Client, userdata: Any, sock) -> None:
+        self.reading = False
+        self._update_reading()
+        self._misc = self.loop.create_task(self._misc_loop())
+
+    def on_socket_close(self, client: Client, userdata: Any, sock) -> None:
+        if self.reading:
+            self.loop.remove_reader(sock)
+            self.reading = False
+        if self._misc:
+            self._misc.cancel()
+
+    def on_socket_register_write(self, client: Client, userdata: Any, sock) -> None:
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client: Client, userdata: Any, sock) -> None:
+        self.loop.remove_writer(sock)
+
+    async def _misc_loop(self) -> None:
+        """Keepalive pings and retries, what loop_start() does once a second on its thread"""
+        while self.client.loop_misc() == MQTT_ERR_SUCCESS:
+            # read while a ping is outstanding, pause again once it was answered
+            self._update_reading()
+            await asyncio.sleep(1)
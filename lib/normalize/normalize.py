@@ -0,0 +1,105 @@
+"""
+Declarative metric normalization shared by the influx bridges
+
+Rules map a source metric name to how it is stored:
+    {"Temperature_C": {"rename": "temperature", "type": "float"},
+     "temperature_F": {"rename": "temperature", "type": "float", "scale": 0.5556, "offset": -17.778},
+     "elevation": {"drop": true}}
+Each metric is compiled into a converter the first time it is seen and cached, so normalizing a
+reading is one dict lookup and one call. Metrics without a rule pass through unchanged and are counted.
+"""
+
+import collections
+import json
+import threading
+from typing import Callable
+
+DEFAULT_RULES = {
+    'Temperature_C': {'rename': 'temperature', 'type': 'float'},
+    'Humidity_Pct': {'rename': 'humidity', 'type': 'float'},
+    'relativeHumidity': {'rename': 'humidity', 'type': 'float'},
+    'temperature': {'type': 'float'},
+    'dewpoint': {'type': 'float'},
+    'windSpeed': {'type': 'float'},
+    'humidity': {'type': 'float'},
+    'elevation': {'drop': True},
+}
+
+BOOL_TOKENS = {
+    'true': True, '1': True, 'on': True, 'yes': True,
+    'false': False, '0': False, 'off': False, 'no': False,
+}
+
+
+def to_bool(value) -> bool:
+    """Parse true/false, 1/0, on/off and yes/no from str or bytes payloads, raises ValueError on anything else"""
+    if isinstance(value, (bool, int, float)):
+        return bool(value)
+    token = value.decode() if isinstance(value, (bytes, bytearray)) else str(value)
+    try:
+        return BOOL_TOKENS[token.strip().lower()]
+    except KeyError:
+        raise ValueError(f'not a boolean: {value!r}')
+
+
+def to_str(value) -> str:
+    return value.decode() if isinstance(value, (bytes, bytearray)) else str(value)
+
+
+TYPES = {
+    'float': float,
+    'int': int,
+    'str': to_str,
+    'bool': to_bool,
+}
+
+
+class Normalizer():
+    def __init__(self, rules: dict = None) -> None:
+        self.rules = DEFAULT_RULES if rules is None else rules
+        self.converters = {}
+        self.unknown = collections.Counter()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, path: str = None):
+        """Default rules, overridden per metric by a JSON file of rules if path is given"""
+        rules = dict(DEFAULT_RULES)
+        if path:
+            with open(path) as fileh:
+                rules.update(json.load(fileh))
+        return cls(rules)
+
+    def normalize(self, metric: str, value) -> tuple | None:
+        """Returns (name, value) as it should be stored, None if the metric is dropped"""
+        try:
+            converter = self.converters[metric]
+        except KeyError:
+            converter = self.converters[metric] = self.compile(metric)
+        return converter(value)
+
+    def compile(self, metric: str) -> Callable:
+        rule = self.rules.get(metric)
+        if rule is None:
+            def unknown(value):
+                with self.lock:
+                    self.unknown[metric] += 1
+                return metric, value
+            return unknown
+        if rule.get('drop'):
+            return lambda value: None
+
+        name = rule.get('rename', metric)
+        cast = TYPES[rule['type']] if rule.get('type') else None
+        scale = rule.get('scale', 1)
+        offset = rule.get('offset', 0)
+        if scale != 1 or offset:
+            cast = cast or float
+            return lambda value: (name, cast(value) * scale + offset)
+        if cast:
+            return lambda value: (name, cast(value))
+        return lambda value: (name, value)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'converters': len(self.converters), 'unknown': dict(self.unknown)}
@@ -5,116 +5,297 @@ Read MQTT temperature metrics and send data to influxdb
 Author: Pete Ezzo <peter.ezzo@gmail.com>
 """
 
-import datetime
+import heapq
+import json
 import os
+import threading
 import time
+from typing import Tuple
 
-from influxdb import InfluxDB  # type: ignore
+from influxdb import InfluxDB, LineEncoder, WindowAggregator  # type: ignore
 from mqtt import MQTT  # type: ignore
+from normalize import Normalizer  # type: ignore
+
+
+class LatestReadings():
+    """
+    Latest value and its time per (sensor, metric), kept current by relay_metric for MQTT sensors and by
+    reseeding from Influx for series written by other bridges (e.g. NWS stations)
+    """
+    def __init__(self, max_age: float = 3 * 3600) -> None:
+        self.max_age = max_age
+        self.values = {}  # (sensor, metric): (value, timestamp)
+        self.lock = threading.Lock()
+
+    def update(self, sensor: str, metric: str, value, timestamp: float) -> None:
+        key = (sensor, metric)
+        with self.lock:
+            current = self.values.get(key)
+            if current is None or timestamp >= current[1]:
+                self.values[key] = (value, timestamp)
+
+    def seed(self, tables) -> int:
+        """Load the last value of every series from a Flux query result, returns the number of series"""
+        count = 0
+        for table in tables:
+            for record in table:
+                self.update(record.values.get('sensor'), record.get_field(), record.get_value(),
+                            record.get_time().timestamp())
+                count += 1
+        return count
+
+    def metric(self, metric: str) -> list:
+        """(sensor, value, age in seconds) for every sensor with a recent reading of metric"""
+        now = time.time()
+        with self.lock:
+            readings = [(sensor, value, now - timestamp) for (sensor, name), (value, timestamp) in self.values.items()
+                        if name == metric and now - timestamp < self.max_age]
+        return sorted(readings, key=lambda reading: str(reading[0]))
+
+
+class LivenessTracker():
+    """
+    Online/offline state per sensor from expiry deadlines in a min-heap
+
+    seen() records a reading from any thread in O(1). Every tracked sensor has one heap entry, which is
+    pushed back to the sensor's current deadline when it comes up while the sensor is still reporting,
+    so the waiting thread only has work when a deadline passes instead of scanning every sensor.
+    """
+    def __init__(self, timeout: float = 5 * 60, timeouts: dict = None, coalesce: float = 1.0) -> None:
+        self.timeout = timeout
+        self.timeouts = timeouts or {}
+        self.coalesce = coalesce
+        self.deadlines = {}  # sensor: monotonic time it goes offline without another reading
+        self.heap = []       # (deadline, sensor), at most one per sensor
+        self.came_online = []
+        self.cond = threading.Condition()
+
+    def seen(self, sensor: str) -> None:
+        deadline = time.monotonic() + self.timeouts.get(sensor, self.timeout)
+        with self.cond:
+            if sensor not in self.deadlines:
+                heapq.heappush(self.heap, (deadline, sensor))
+                self.came_online.append(sensor)
+                self.cond.notify()
+            self.deadlines[sensor] = deadline
+
+    def wait(self, timeout: float = None) -> Tuple[list, list]:
+        """
+        Block until sensors come online or time out, returns (online, offline), empty lists on timeout.
+        Transitions are collected for coalesce seconds after the first one, so a burst of them (e.g. every
+        sensor coming online after a restart) is returned at once.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        flush = None  # when the transitions collected so far are returned
+        offline = []
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.heap and self.heap[0][0] <= now:
+                    deadline, sensor = heapq.heappop(self.heap)
+                    current = self.deadlines[sensor]
+                    if current > deadline:
+                        heapq.heappush(self.heap, (current, sensor))
+                    else:
+                        del self.deadlines[sensor]
+                        offline.append(sensor)
+                if (self.came_online or offline) and flush is None:
+                    flush = now + self.coalesce
+                if (flush is not None and now >= flush) or (end is not None and now >= end):
+                    online, self.came_online = self.came_online, []
+                    return online, offline
+                wake = [t for t in (self.heap[0][0] if self.heap else None, flush, end) if t is not None]
+                self.cond.wait(min(wake) - now if wake else None)
 
 
 class Bridge():
     def __init__(self) -> None:
-        self.lastseen = {}
-        self.state = {}
+        # INFLUX_SENSOR_TIMEOUTS overrides the offline timeout per sensor, e.g. garage=900;attic=600
+        timeouts = {}
+        for override in filter(None, os.getenv('INFLUX_SENSOR_TIMEOUTS', '').split(';')):
+            sensor, seconds = override.split('=')
+            timeouts[sensor.strip()] = float(seconds)
+        self.liveness = LivenessTracker(float(os.getenv('INFLUX_SENSOR_TIMEOUT', 5 * 60)), timeouts)
+        self.encoder = LineEncoder('environmental', 'sensor')
+        self.latest = LatestReadings()
+        self.normalizer = Normalizer.from_config(os.getenv('NORMALIZE_RULES'))
+        # readings older than this, or than the sensor's INFLUX_SENSOR_TIMEOUTS override, are flagged in replies
+        self.stale_after = float(os.getenv('INFLUX_STALE_AFTER', 5 * 60))
+        # series that do not arrive over MQTT are picked up by reloading the cache from Influx
+        self.refresh_interval = float(os.getenv('INFLUX_REFRESH_INTERVAL', 5 * 60))
+        self.mqtt_sensors = set()  # sensors relay_metric keeps current, left out of the reloads
 
-    def relay_metric(self, mosq, obj, msg):
+    def relay_metric(self, msg, location, metric):
         """
-        Send a message to InfluxDB when reading arrives in broker (MQTT Callback)
+        Send a message to InfluxDB when reading arrives in broker (MQTT Route)
         """
-        _, location, metric = msg.topic.split('/')
-        value = msg.payload
-
-        if metric == 'Temperature_C':
-            metric = 'temperature'
-        elif metric == 'Humidity_Pct':
-            metric = 'humidity'
-
-        if metric in ['temperature', 'dewpoint', 'windSpeed', 'humidity']:
-            value = float(value)
-
-        data_payload = {
-            'measurement': 'environmental',
-            'tags': {
-                'sensor': location
-            },
-            'time': str(datetime.datetime.utcnow().replace(microsecond=0)),
-            'fields': {
-                metric: value,
-            }
-        }
-        print(data_payload, flush=True)
-        self.db.write(data_payload)
-        self.lastseen[location] = time.time()
+        arrival = time.time_ns()
+        self.liveness.seen(location)
+        normalized = self.normalizer.normalize(metric, msg.payload)
+        if normalized is None:
+            return
+        metric, value = normalized
+
+        line = self.encoder.encode(location, metric, value, arrival)
+        if line is None:
+            print(f'Skipping unstorable {metric} value {value!r} from {location}', flush=True)
+            return
+        print(line, flush=True)
+        self.db.write(line)
+        self.aggregator.add(location, metric, value, arrival)
+        self.latest.update(location, metric, value, arrival / 1e9)
+        self.mqtt_sensors.add(location)
 
     def pull_temperatures(self):
         print('Temperatures cmd received', flush=True)
-        query = '\n'.join(['from(bucket: "Environment")',
-                           '|> range(start: -3h)',
-                           '|> last()',
-                           '|> filter(fn: (r) =>',
-                           '  r._measurement == "environmental" and',
-                           '  r._field == "temperature"',
-                           ')',
-                           '|> toFloat()',
-                           '|> map(fn: (r) => ({r with _value: r._value * 1.8 + 32.0}))'
-                           ])
-        self._pull_metric(query, ' °F')
+        if self._reply_latest('temperature', ' °F', lambda celsius: celsius * 1.8 + 32.0):
+            return
+        self._pull_metric('temperature',
+                          ['|> toFloat()', '|> map(fn: (r) => ({r with _value: r._value * 1.8 + 32.0}))'], ' °F')
 
     def pull_humidity(self):
         print('Humidities cmd received', flush=True)
+        if self._reply_latest('humidity', '%'):
+            return
+        self._pull_metric('humidity', tail='%')
+
+    def _reply_latest(self, metric, tail='', convert=float):
+        """Answer from the latest readings cache, returns False on a cold cache so Influx is queried instead"""
+        readings = self.latest.metric(metric)
+        if not readings:
+            return False
+        results = []
+        for sensor, value, age in readings:
+            stale_after = self.liveness.timeouts.get(sensor, self.stale_after)
+            stale = f' (stale, {age / 60:.0f} min old)' if age > stale_after else ''
+            results.append(f'{sensor}: {convert(value):.1f}{tail}{stale}')
+        print(results, flush=True)
+        self.mqtt.pub('Notifications/cmd-reply', '\n' + '\n'.join(results), qos=1)
+        return True
+
+    @staticmethod
+    def _seed_query(exclude=()):
+        """Flux for the last value of every environmental series, skipping the sensors in exclude"""
+        skip = [f'  and not contains(value: r.sensor, set: {json.dumps(sorted(exclude))})'] if exclude else []
+        return '\n'.join(['from(bucket: "Environment")',
+                          '|> range(start: -3h)',
+                          '|> filter(fn: (r) =>',
+                          '  r._measurement == "environmental"',
+                          *skip,
+                          ')',
+                          '|> last()'
+                          ])
+
+    def seed_latest(self, exclude=()) -> None:
+        try:
+            count = self.latest.seed(self.db.query(self._seed_query(exclude)))
+            print(f'Seeded latest readings for {count} series', flush=True)
+        except Exception as e:
+            print(f'Could not seed latest readings, commands will query Influx: {e}', flush=True)
+
+    def seed_aggregates(self) -> None:
+        """Reopen the aggregate windows written at the last shutdown that are still open"""
+        measurements = ' or '.join(f'r._measurement == "{name}"' for name in self.aggregator.measurements)
         query = '\n'.join(['from(bucket: "Environment")',
-                           '|> range(start: -3h)',
-                           '|> last()',
-                           '|> filter(fn: (r) =>',
-                           '  r._measurement == "environmental" and',
-                           '  r._field == "humidity"',
-                           ')'
+                           '|> range(start: -2h)',
+                           f'|> filter(fn: (r) => {measurements})',
+                           '|> last()'
                            ])
-        self._pull_metric(query, '%')
+        try:
+            count = self.aggregator.seed(self.db.query(query))
+            print(f'Reopened {count} aggregate windows', flush=True)
+        except Exception as e:
+            print(f'Could not reopen aggregate windows, readings will overwrite them: {e}', flush=True)
+
+    @staticmethod
+    def _metric_query(measurement, field, transform=(), exclude=()):
+        """Flux for the latest value of field per sensor in measurement, skipping the sensors in exclude"""
+        skip = [f'  and not contains(value: r.sensor, set: {json.dumps(sorted(exclude))})'] if exclude else []
+        return '\n'.join(['from(bucket: "Environment")',
+                          '|> range(start: -3h)',
+                          '|> filter(fn: (r) =>',
+                          f'  r._measurement == "{measurement}" and',
+                          f'  r._field == "{field}"',
+                          *skip,
+                          ')',
+                          '|> last()',
+                          *transform
+                          ])
 
-    def _pull_metric(self, query, tail=''):
-        db_response = self.db.query(query)
-        results = [f'{r.values.get("sensor")}: {r.get_value():.1f}' for t in db_response for r in t]
+    def _pull_metric(self, field, transform=(), tail=''):
+        """
+        Latest value per sensor from the 1 minute aggregates, and from the raw points for sensors that have
+        no aggregates (series written by other bridges, e.g. NWS stations)
+        """
+        values = {}
+        for measurement, name in (('environmental_1m', f'{field}_mean'), ('environmental', field)):
+            for table in self.db.query(self._metric_query(measurement, name, transform, values)):
+                for record in table:
+                    values.setdefault(record.values.get('sensor'), record.get_value())
+        results = [f'{sensor}: {value:.1f}' for sensor, value in sorted(values.items(), key=lambda item: str(item[0]))]
         print(results, flush=True)
         self.mqtt.pub('Notifications/cmd-reply', '\n' + f'{tail}\n'.join(results) + f'{tail}', qos=1)
 
+    def pull_writer_stats(self):
+        print('Writer stats cmd received', flush=True)
+        stats = self.db.stats()
+        for topic, dispatch in self.mqtt.dispatch_stats().items():
+            stats.update({f'{topic} {k}': v for k, v in dispatch.items()})
+        stats.update({f'normalize {k}': v for k, v in self.normalizer.stats().items()})
+        self.mqtt.pub('Notifications/cmd-reply', '\n' + '\n'.join(f'{k}: {v}' for k, v in stats.items()), qos=1)
+
     def cmd_dispatcher(self, mosq, obj, msg):
         cmd = msg.payload.decode()
         if cmd == 'get-temperatures':
             self.pull_temperatures()
         elif cmd == 'get-humidities':
             self.pull_humidity()
+        elif cmd == 'get-writer-stats':
+            self.pull_writer_stats()
         else:
             print('Unknown cmd received', cmd, flush=True)
 
-    def detect_state(self):
-        now = time.time()
-        for sensor, lastseen in self.lastseen.items():
-            online = self.state.get(sensor, False)
-            if online and now - lastseen > 5 * 60:
-                self.mqtt.pub('Notifications/sensors', f'{sensor} is offline', verbose=True)
-                self.state[sensor] = False
-            elif not online and now - lastseen < 5 * 60:
-                self.mqtt.pub('Notifications/sensors', f'{sensor} is online', verbose=True)
-                self.state[sensor] = True
+    def publish_transitions(self, online: list, offline: list) -> None:
+        """One notification for every batch of sensor state changes"""
+        lines = [f'{sensor} is online' for sensor in online] + [f'{sensor} is offline' for sensor in offline]
+        if lines:
+            self.mqtt.pub('Notifications/sensors', '\n'.join(lines), verbose=True)
 
     def start(self) -> None:
         mqtt_broker = os.getenv('MQTT_BROKER')
 
-        self.db = InfluxDB('Environment')
+        self.db = InfluxDB('Environment', batching=True, spool_dir=os.getenv('INFLUX_SPOOL_DIR'))
+        # 1 minute and 1 hour min/max/mean/count written as environmental_1m and environmental_1h
+        self.aggregator = WindowAggregator(self.db.write, 'environmental', 'sensor')
+        self.seed_aggregates()
+        self.seed_latest()
 
         self.mqtt = MQTT(mqtt_broker, client_id='mqtt-influxdb-bridge')
         self.mqtt.listen()
         print('MQTT startup complete')
 
         print('adding callbacks', flush=True)
-        self.mqtt.sub(self.relay_metric, 'Sensors/#')
-        self.mqtt.sub(self.cmd_dispatcher, 'Commands/Influx', 0)
+        self.mqtt.route('Sensors/{location}/{metric}', self.relay_metric)
+        self.mqtt.sub(self.cmd_dispatcher, 'Commands/Influx', 0, workers=1)
 
-        while True:
-            self.detect_state()
-            time.sleep(1)
+        try:
+            refresh = time.monotonic() + self.refresh_interval
+            while True:
+                # sleeps until a sensor reports for the first time, crosses its timeout, an aggregate window
+                # closes or the latest readings are due to be reloaded
+                timeout = max(0., refresh - time.monotonic())
+                close = self.aggregator.next_close()
+                self.publish_transitions(*self.liveness.wait(timeout if close is None else min(close, timeout)))
+                self.aggregator.expire()
+                if time.monotonic() >= refresh:
+                    # only series written by other bridges, what arrives over MQTT is already current
+                    self.seed_latest(set(self.mqtt_sensors))
+                    refresh = time.monotonic() + self.refresh_interval
+        finally:
+            self.mqtt.stop()
+            # write the windows still open so the last minutes are not lost
+            self.aggregator.expire(force=True)
+            self.db.close()
 
 
 if __name__ == '__main__':
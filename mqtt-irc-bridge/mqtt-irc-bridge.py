@@ -4,19 +4,26 @@ Python IRC Client controlled by MQTT Broker (tested with Mosquitto)
 Author: Pete Ezzo <peter.ezzo@gmail.com>
 """
 
+import ctypes
+import ctypes.util
 import hashlib
 import json
 import os
 import pathlib
+import queue
 import re
 import struct
+import threading
+import time
+from collections import deque
 from functools import wraps
-from typing import Any, Callable, Tuple
-from ircbot import IRCBot, ServerConnection, Event, DCCConnectionError  # type: ignore
-from mqtt import MQTT, Client, MQTTMessage  # type: ignore
+from typing import Callable, Tuple
+from ircbot import IRCBot, ServerConnection, Event, DCCConnection, DCCConnectionError, WatchlistMatcher  # type: ignore
+from mqtt import MQTT, MQTTMessage, BatchPublisher  # type: ignore
 
 
 HEALTHCHECK = pathlib.Path('/dev/shm/irc_healthcheck')
+MD5_NOTICE = re.compile(r'.{21,35}\"([^\"]+)\".{3,15}\w{3}:([^\]]+)')
 
 
 def healthcheck(fn: Callable) -> Callable:
@@ -32,22 +39,376 @@ def log(*args, **kwargs):
     print(*args, **kwargs)
 
 
+def load_libcrypto():
+    # find_library needs ldconfig or a compiler, which the alpine base image does not have
+    for path in (ctypes.util.find_library('crypto'), 'libcrypto.so.3', 'libcrypto.so'):
+        if not path:
+            continue
+        try:
+            lib = ctypes.CDLL(path)
+            lib.MD5_Init.argtypes = [ctypes.c_void_p]
+            lib.MD5_Update.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+            lib.MD5_Final.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        except (OSError, AttributeError):
+            continue
+        return lib
+    return None
+
+
+LIBCRYPTO = load_libcrypto()
+
+
+class MD5_CTX(ctypes.Structure):
+    """MD5state_st as declared in openssl/md5.h"""
+    _fields_ = [('A', ctypes.c_uint32), ('B', ctypes.c_uint32), ('C', ctypes.c_uint32), ('D', ctypes.c_uint32),
+                ('Nl', ctypes.c_uint32), ('Nh', ctypes.c_uint32), ('data', ctypes.c_uint32 * 16),
+                ('num', ctypes.c_uint)]
+
+
+class ResumableMD5():
+    """
+    MD5 whose running state can be saved and restored, so a resumed transfer carries on hashing where it
+    stopped. Uses MD5_CTX from libcrypto, without it falls back to hashlib and state() returns None.
+
+    The saved state is MD5's own rather than the bytes of the C struct: the four chaining words, the number
+    of bytes hashed and the tail of the last incomplete block, so it does not depend on the libcrypto build.
+    """
+    def __init__(self, state: dict | None = None) -> None:
+        self._lock = threading.Lock()
+        if state and LIBCRYPTO is None:
+            raise ValueError('restoring MD5 state needs libcrypto')
+        if LIBCRYPTO is None:
+            self._md5 = hashlib.md5()
+            self._ctx = None
+            return
+        self._ctx = MD5_CTX()
+        if state:
+            self._load(state)
+        else:
+            LIBCRYPTO.MD5_Init(ctypes.byref(self._ctx))
+
+    def _load(self, state: dict) -> None:
+        try:
+            words = struct.unpack('<4I', bytes.fromhex(state['abcd']))
+            length = int(state['length'])
+            tail = bytes.fromhex(state['tail'])
+        except (KeyError, TypeError, ValueError, struct.error) as e:
+            raise ValueError(f'malformed MD5 state: {e}')
+        if length < 0 or len(tail) != length % 64:
+            raise ValueError(f'MD5 state of {length} bytes cannot have a {len(tail)} byte tail')
+        ctx = self._ctx
+        ctx.A, ctx.B, ctx.C, ctx.D = words
+        ctx.Nl, ctx.Nh = length * 8 & 0xffffffff, length >> 29 & 0xffffffff
+        ctypes.memmove(ctx.data, tail, len(tail))
+        ctx.num = len(tail)
+
+    def update(self, data) -> None:
+        with self._lock:
+            if self._ctx is None:
+                self._md5.update(data)
+                return
+            try:
+                buf = (ctypes.c_char * len(data)).from_buffer(data)
+            except TypeError:  # read-only buffers such as bytes
+                buf = bytes(data)
+            LIBCRYPTO.MD5_Update(ctypes.byref(self._ctx), buf, len(data))
+
+    def hexdigest(self) -> str:
+        with self._lock:
+            if self._ctx is None:
+                return self._md5.hexdigest()
+            ctx = MD5_CTX.from_buffer_copy(self._ctx)
+        digest = ctypes.create_string_buffer(16)
+        LIBCRYPTO.MD5_Final(digest, ctypes.byref(ctx))
+        return digest.raw.hex()
+
+    def state(self) -> dict | None:
+        with self._lock:
+            if self._ctx is None:
+                return None
+            ctx = self._ctx
+            return {'abcd': struct.pack('<4I', ctx.A, ctx.B, ctx.C, ctx.D).hex(),
+                    'length': (ctx.Nh << 32 | ctx.Nl) // 8,
+                    'tail': bytes(ctx.data)[:ctx.num].hex()}
+
+    @staticmethod
+    def selftest() -> bool:
+        """Check that MD5_CTX matches the linked libcrypto by restoring a state saved in mid-block"""
+        head, rest = b'resumable' * 15, b'md5' * 30
+        md5 = ResumableMD5()
+        md5.update(head)
+        state = md5.state()
+        if state['length'] != len(head) or state['tail'] != head[-(len(head) % 64):].hex():
+            return False
+        resumed = ResumableMD5(state)
+        resumed.update(rest)
+        return resumed.hexdigest() == hashlib.md5(head + rest).hexdigest()
+
+
+if LIBCRYPTO is not None and not ResumableMD5.selftest():
+    log('WARNING', 'libcrypto does not match the MD5_CTX of openssl/md5.h, transfers cannot save their MD5 state')
+    LIBCRYPTO = None
+
+
+class TransferWriter():
+    """
+    Write and hash a transfer on a worker thread. Reads go into a fixed pool of buffers, when every
+    buffer is waiting to be written acquire() returns None and the connection pauses until one is freed.
+    Given rehash, the first offset bytes of that file are hashed before anything queued is written.
+    """
+    def __init__(self, fileh, md5, bufsize: int = 2**18, depth: int = 32, resume: Callable = None,
+                 offset: int = 0, checkpoint: Callable = None, checkpoint_interval: int = 2**26,
+                 rehash: pathlib.Path = None) -> None:
+        self.fileh = fileh
+        self.md5 = md5
+        self.resume = resume
+        self.offset = offset
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self._checkpointed = offset
+        self.error = None
+        self.rehash = rehash
+        self.rehashing = bool(rehash)
+        self.cancelled = threading.Event()
+        self.free = deque(memoryview(bytearray(bufsize)) for _ in range(depth))
+        self.filled = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='dcc-writer', daemon=True)
+        self.thread.start()
+
+    def acquire(self) -> memoryview | None:
+        try:
+            return self.free.popleft()
+        except IndexError:
+            return None
+
+    def submit(self, data) -> None:
+        self.filled.put(data)
+
+    def run(self) -> None:
+        if self.rehash:
+            self._rehash()
+        while True:
+            data = self.filled.get()
+            if data is None:
+                break
+            if self.error is None:
+                try:
+                    self.fileh.write(data)
+                    self.md5.update(data)
+                    self.offset += len(data)
+                    if self.checkpoint and self.offset - self._checkpointed >= self.checkpoint_interval:
+                        self.sync()
+                except Exception as e:
+                    self.error = e
+            if isinstance(data, memoryview):
+                self.free.append(memoryview(data.obj))
+                if self.resume:
+                    self.resume()
+
+    def _rehash(self) -> None:
+        try:
+            with self.rehash.open('rb') as fileh:
+                remaining = self.offset
+                while remaining:
+                    if self.cancelled.is_set():
+                        raise RuntimeError(f'closed while rehashing, {remaining} bytes left')
+                    chunk = fileh.read(min(2**20, remaining))
+                    if not chunk:
+                        raise EOFError(f'{self.rehash.name} is {remaining} bytes short of {self.offset}')
+                    self.md5.update(chunk)
+                    remaining -= len(chunk)
+        except Exception as e:
+            self.error = e
+        self.rehashing = False
+
+    def sync(self) -> None:
+        """Make everything written so far durable and record it with checkpoint(offset)"""
+        self.fileh.flush()
+        os.fsync(self.fileh.fileno())
+        self.checkpoint(self.offset)
+        self._checkpointed = self.offset
+
+    def close(self, cancel: bool = False) -> None:
+        """Write out everything queued, raises the first write error. cancel stops a rehash in progress."""
+        if cancel:
+            self.cancelled.set()
+        self.filled.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+        if self.checkpoint:
+            self.sync()
+        else:
+            self.fileh.flush()
+
+
+class TokenBucket():
+    """Bandwidth limit of rate bytes per second with bursts of up to burst bytes, a rate of 0 is unlimited"""
+    def __init__(self, rate: float = 0, burst: float = None) -> None:
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def consume(self, nbytes: int) -> float:
+        """Take nbytes from the bucket, returns the seconds to wait before reading more"""
+        if not self.rate:
+            return 0.
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= nbytes
+        return -self.tokens / self.rate if self.tokens < 0 else 0.
+
+
+class Request():
+    """Object queued for download with the sources that still have to be tried"""
+    def __init__(self, name: str, message: str, sources: list) -> None:
+        self.name = name
+        self.message = message
+        self.sources = list(sources)
+        self.tried = []
+        self.sent = 0.
+
+
+class TransferScheduler():
+    """
+    Queue of requested objects, each sent to one of its sources while the global and per-source limits
+    on requested plus running transfers allow. A request that gets no DCC offer within timeout seconds,
+    or whose transfer fails, is retried with the next source.
+    """
+    def __init__(self, send: Callable, max_active: int = 4, max_per_source: int = 1, rate: float = 0,
+                 source_rate: float = 0, timeout: float = 300) -> None:
+        self.send = send
+        self.max_active = max_active
+        self.max_per_source = max_per_source
+        self.source_rate = source_rate
+        self.timeout = timeout
+        self.queue = deque()
+        self.pending = {}  # src: [Request] waiting for a DCC offer
+        self.active = {}   # src: running transfers
+        self.completed = 0
+        self.failed = []
+        self.bucket = TokenBucket(rate)
+        self.buckets = {}
+        self.lock = threading.RLock()
+
+    def enqueue(self, name: str, message: str, sources: list) -> None:
+        with self.lock:
+            self.queue.append(Request(name, message, sources))
+
+    def inflight(self, src: str = None) -> int:
+        if src is None:
+            return sum(len(requests) for requests in self.pending.values()) + sum(self.active.values())
+        return len(self.pending.get(src, ())) + self.active.get(src, 0)
+
+    def pump(self) -> None:
+        """Expire unanswered requests and send queued ones while there is capacity, run from a reactor timer"""
+        with self.lock:
+            now = time.monotonic()
+            for src, requests in list(self.pending.items()):
+                for request in [r for r in requests if now - r.sent > self.timeout]:
+                    log('TIMEOUT', f'No DCC offer for {request.name} from {src}')
+                    requests.remove(request)
+                    self._retry(request)
+                if not requests:
+                    del self.pending[src]
+
+            waiting = []
+            while self.queue and self.inflight() < self.max_active:
+                request = self.queue.popleft()
+                src = next((s for s in request.sources if self.inflight(s) < self.max_per_source), None)
+                if src is None:
+                    waiting.append(request)
+                    continue
+                request.sources.remove(src)
+                request.tried.append(src)
+                request.sent = now
+                self.pending.setdefault(src, []).append(request)
+                self.send(src, request.message)
+            self.queue.extendleft(reversed(waiting))
+
+    def claim(self, src: str, name: str) -> Tuple[bool, Request | None]:
+        """
+        Account for a DCC offer that is about to start, returns whether it may start and the request it
+        answers. Offers are matched to requests by file name only, an offer nobody queued leaves the pending
+        requests alone and is allowed while there is capacity.
+        """
+        with self.lock:
+            requests = self.pending.get(src, [])
+            name = pathlib.Path(name).name
+            request = next((r for r in requests if pathlib.Path(r.name).name == name), None)
+            if request:
+                requests.remove(request)
+                if not requests:
+                    del self.pending[src]
+            elif self.inflight() >= self.max_active or self.inflight(src) >= self.max_per_source:
+                return False, None
+            self.active[src] = self.active.get(src, 0) + 1
+            return True, request
+
+    def finish(self, src: str, request: Request | None, ok: bool) -> None:
+        with self.lock:
+            self.active[src] -= 1
+            if not self.active[src]:
+                del self.active[src]
+            if ok:
+                self.completed += 1
+            elif request:
+                self._retry(request)
+
+    def _retry(self, request: Request) -> None:
+        if request.sources:
+            self.queue.appendleft(request)
+        else:
+            log('FAILED', f'{request.name} failed from every source: {", ".join(request.tried)}')
+            self.failed.append(request)
+
+    def throttle(self, src: str, nbytes: int) -> float:
+        """Charge nbytes received from src against the bandwidth limits, returns the seconds to pause"""
+        bucket = self.buckets.get(src)
+        if bucket is None:
+            bucket = self.buckets[src] = TokenBucket(self.source_rate)
+        return max(self.bucket.consume(nbytes), bucket.consume(nbytes))
+
+    def status(self) -> str:
+        with self.lock:
+            requested = sum(len(requests) for requests in self.pending.values())
+            return f'{len(self.queue)} queued, {requested} requested, {sum(self.active.values())} active, ' + \
+                   f'{self.completed} completed, {len(self.failed)} failed'
+
+
 class Transfer():
+    __slots__ = ('md5', 'connection', 'src', 'ip', 'port', 'startat', 'size', 'ack_mode', 'request',
+                 '_fileh', '_writer', '_ack', 'acked', 'acks_sent', '_md5', 'filename', 'received_bytes',
+                 '_checkpoint', 'resume_sent')
+
     def __init__(self, filename: str) -> None:
         # this first block of variables must be provided externally
         self.md5 = None
         self.connection = None
+        self.src = ''
         self.ip = ''
         self.port = 0
         self.startat = 0
         self.size = 0
+        self.ack_mode = 'every'
+        self.request = None
 
         # remaining variables are controlled internally
         self._fileh = None
-        self._md5 = hashlib.md5()
+        self._writer = None
+        self._ack = None
+        self.acked = 0
+        self.acks_sent = 0
+        self._md5 = ResumableMD5()
         self.filename = pathlib.Path('/data/inprogress') / pathlib.Path(filename).name
         self.received_bytes = 0
-        if self.filename.exists():
+        self.resume_sent = 0.  # monotonic time a DCC RESUME went out, 0 once it was accepted
+        self._checkpoint = self.load_checkpoint()
+        if self._checkpoint:
+            self.received_bytes = self._checkpoint['offset']
+        elif self.filename.exists():
             self.received_bytes = self.disksize
 
     def update(self, **kwargs) -> None:
@@ -56,27 +417,108 @@ class Transfer():
                 value = int(value)
             setattr(self, key, value)
 
-    def start(self) -> None:
-        self._fileh = self.filename.open('wb')
-        self._fileh.seek(self.startat)
+    def start(self, bufsize: int = 2**18, depth: int = 32, checkpoint_interval: int = 2**26) -> None:
+        # DCC ACKs are the received offset as a 32-bit big-endian unsigned int, 64-bit for files over 4GiB
+        self._ack = struct.Struct('!I' if self.size <= 4294967295 else '!Q')
+        self.resume_sent = 0.
+        rehash = None
+        if self.startat:
+            if not self.restore(self.startat):
+                rehash = self.filename
+            self._fileh = self.filename.open('ab')
+        else:
+            self._md5 = ResumableMD5()
+            self.received_bytes = 0
+            self._fileh = self.filename.open('wb')
+        self.acked = self.received_bytes
+        self._writer = TransferWriter(self._fileh, self._md5, bufsize, depth, self.connection.resume,
+                                      self.received_bytes, self.save_checkpoint, checkpoint_interval, rehash)
         self.connection.connect(self.ip, self.port)
 
-    def write(self, data: bytes) -> int:
-        self._fileh.write(data)
-        self._md5.update(data)
+    @property
+    def checkpoint_file(self) -> pathlib.Path:
+        return self.filename.with_name(self.filename.name + '.checkpoint')
+
+    def load_checkpoint(self) -> dict | None:
+        """Last saved offset and MD5 state, ignored if the file on disk is shorter than the checkpoint"""
+        try:
+            checkpoint = json.loads(self.checkpoint_file.read_text())
+        except (OSError, ValueError):
+            return None
+        if checkpoint.get('offset', 0) > self.disksize:
+            return None
+        return checkpoint
+
+    def save_checkpoint(self, offset: int) -> None:
+        """Called from the writer thread once everything up to offset is on disk and hashed"""
+        checkpoint = {'offset': offset, 'md5': self._md5.state()}
+        tmp = self.checkpoint_file.with_suffix('.tmp')
+        tmp.write_text(json.dumps(checkpoint))
+        tmp.replace(self.checkpoint_file)
+        self._checkpoint = checkpoint
+
+    def restore(self, offset: int) -> bool:
+        """
+        Cut the partial file back to offset and pick up the MD5 state saved there, returns False when there
+        is none and the writer has to hash the partial file before appending to it
+        """
+        checkpoint = self._checkpoint
+        with self.filename.open('ab') as fileh:
+            fileh.truncate(offset)
+        try:
+            if not (checkpoint and checkpoint['offset'] == offset and checkpoint.get('md5')):
+                raise ValueError(f'there is no checkpoint at {offset}')
+            self._md5 = ResumableMD5(checkpoint['md5'])
+            restored = True
+        except ValueError as e:
+            # no usable checkpoint for this offset, or libcrypto is missing to load it: hash what is on disk once,
+            # on the writer thread so the reactor keeps running
+            log('REHASH', f'Hashing partial file of {self.name}, {e}')
+            self._md5 = ResumableMD5()
+            restored = False
+        self.received_bytes = offset
+        return restored
+
+    def buffer(self) -> memoryview | None:
+        """Free receive buffer from the writer pool, None while the writer is behind"""
+        return self._writer.acquire()
+
+    def write(self, data) -> int:
+        """Queue data for the writer thread, data must not be reused by the caller unless it came from buffer()"""
+        self._writer.submit(data)
         self.received_bytes = self.received_bytes + len(data)
         return self.received_bytes
 
-    def close(self) -> None:
+    def send_ack(self) -> None:
+        """Acknowledge everything received so far, skipped if nothing new arrived since the last ACK"""
+        if self.received_bytes != self.acked:
+            self.connection.send_bytes(self._ack.pack(self.received_bytes))
+            self.acked = self.received_bytes
+            self.acks_sent += 1
+
+    def abort(self) -> None:
+        """Disconnect and release the writer and file, leaving the partial file and checkpoint in place"""
+        if self.connection and self.connection.connected:
+            self.connection.disconnect()
+        try:
+            self._writer.close(cancel=not self.complete)
+        except AttributeError:
+            pass
+        except Exception as e:
+            log('WTF-WRITE', e, self)
+        self._writer = None
         try:
             self._fileh.close()
         except AttributeError:
             pass
         self._fileh = None
-        if self.connection and self.connection.connected:
-            self.connection.disconnect()
 
-        if 'progress' in str(self.filename.resolve()):
+    def close(self) -> None:
+        self.abort()
+
+        # partial files stay in inprogress next to their checkpoint so they can be resumed
+        if 'progress' in str(self.filename.resolve()) and (self.complete or not self._checkpoint):
+            self.checkpoint_file.unlink(missing_ok=True)
             destdir = pathlib.Path('../') if self.verified else pathlib.Path('../unverified')
             self.filename = self.filename.rename(self.filename.parent / destdir / self.filename.name)
 
@@ -92,14 +534,33 @@ class Transfer():
             size = 0
         return size
 
+    @property
+    def complete(self) -> bool:
+        return bool(self.size) and self.received_bytes >= self.size
+
+    @property
+    def resumable(self) -> bool:
+        return 0 < self.received_bytes < self.size
+
     @property
     def fileopen(self) -> bool:
         return bool(self._fileh)
 
+    @property
+    def rehashing(self) -> bool:
+        return bool(self._writer) and self._writer.rehashing
+
     @property
     def verified(self) -> bool:
         return self.md5 == self._md5.hexdigest()
 
+    @property
+    def acks_per_mb(self) -> float:
+        try:
+            return self.acks_sent / ((self.received_bytes - self.startat) / 2**20)
+        except ZeroDivisionError:
+            return 0.
+
     @property
     def pct_complete(self) -> float:
         try:
@@ -121,10 +582,91 @@ class Transfer():
             'ip': self.ip,
             'port': self.port,
             'startat': self.startat,
-            'received_bytes': self.received_bytes
+            'received_bytes': self.received_bytes,
+            'ack_mode': self.ack_mode,
+            'acks_per_mb': self.acks_per_mb
         })
 
 
+class TransferRegistry():
+    """
+    Known transfers indexed by name, src and ip, running ones also by connection. Transfers are inserted
+    when offered, so those waiting for a DCC ACCEPT are found too. The last retain finished transfers
+    are kept for status queries.
+    """
+    def __init__(self, retain: int = 100) -> None:
+        self.active = {}   # connection: transfer
+        self.by_name = {}  # name: transfer
+        self.by_src = {}   # src: {transfer: None}
+        self.by_ip = {}    # ip: {transfer: None}
+        self.keys = {}     # transfer: (name, src, ip) it is indexed under
+        self.finished = deque(maxlen=retain)
+
+    def add(self, transfer: Transfer) -> None:
+        """Insert or reindex a transfer after its src or ip changed"""
+        keys = (transfer.name, transfer.src, transfer.ip)
+        if self.keys.get(transfer) == keys:
+            return
+        self._unindex(transfer)
+        self.keys[transfer] = keys
+        self.by_name[transfer.name] = transfer
+        self.by_src.setdefault(transfer.src, {})[transfer] = None
+        self.by_ip.setdefault(transfer.ip, {})[transfer] = None
+
+    def activate(self, transfer: Transfer) -> None:
+        self.add(transfer)
+        self.active[transfer.connection] = transfer
+
+    def remove(self, transfer: Transfer, retain: bool = True) -> None:
+        self._unindex(transfer)
+        if self.active.get(transfer.connection) is transfer:
+            del self.active[transfer.connection]
+        if retain:
+            self.finished.append(transfer)
+
+    def pop(self, connection) -> Transfer | None:
+        transfer = self.active.get(connection)
+        if transfer:
+            self.remove(transfer)
+        return transfer
+
+    def _unindex(self, transfer: Transfer) -> None:
+        keys = self.keys.pop(transfer, None)
+        if not keys:
+            return
+        name, src, ip = keys
+        if self.by_name.get(name) is transfer:
+            del self.by_name[name]
+        for index, key in ((self.by_src, src), (self.by_ip, ip)):
+            transfers = index.get(key)
+            if transfers is not None:
+                transfers.pop(transfer, None)
+                if not transfers:
+                    del index[key]
+
+    def get(self, connection) -> Transfer | None:
+        return self.active.get(connection)
+
+    def find_by_name(self, name: str) -> Transfer | None:
+        return self.by_name.get(name)
+
+    def find_by_src(self, src: str) -> list:
+        return list(self.by_src.get(src, ()))
+
+    def find_by_ip(self, ip: str) -> list:
+        return list(self.by_ip.get(ip, ()))
+
+    def values(self):
+        return self.active.values()
+
+    def waiting(self) -> list:
+        """Offered transfers that are not running, e.g. waiting for a DCC ACCEPT"""
+        return [transfer for transfer in self.keys if self.active.get(transfer.connection) is not transfer]
+
+    def __len__(self) -> int:
+        return len(self.active)
+
+
 class Bot():
     def __init__(self) -> None:
         self.mqtt = MQTT(os.getenv('MQTT_BROKER'),
@@ -141,8 +683,29 @@ class Bot():
                           os.getenv('IRC_CHANNELS').split(';'),
                           proxy=(os.getenv('IRC_PROXY_HOST'), int(os.getenv('IRC_PROXY_PORT')))
                           )
-        self.watchlist = os.getenv('IRC_WATCHLIST').split(';')
-        self.transfers = {}
+        self.watchlist = WatchlistMatcher.from_config(os.getenv('IRC_WATCHLIST').split(';'),
+                                                      os.getenv('IRC_WATCHLIST_PATTERNS'))
+        # seconds to collect announcements into one IRC/watchlist/<framing> message, 0 publishes each one
+        self.watchlist_batch = float(os.getenv('IRC_WATCHLIST_BATCH', 0.5))
+        self.watchlist_framing = os.getenv('IRC_WATCHLIST_FRAMING', 'length')
+        self.announcements = None
+        self.transfers = TransferRegistry(int(os.getenv('IRC_TRANSFER_HISTORY', 100)))
+        self.dcc_bufsize = int(os.getenv('IRC_DCC_BUFSIZE', 2**18))
+        # every: ACK each read, coalesce: one ACK per reactor tick, turbo: no ACKs (sender must support it)
+        self.dcc_ack_mode = os.getenv('IRC_DCC_ACK', 'coalesce')
+        # receive buffers per transfer waiting on the writer thread before reads pause
+        self.dcc_queue_depth = int(os.getenv('IRC_DCC_QUEUE', 32))
+        # bytes between resume checkpoints of offset and MD5 state
+        self.dcc_checkpoint = int(os.getenv('IRC_DCC_CHECKPOINT', 2**26))
+        # seconds to wait for a DCC offer or the answer to a DCC RESUME
+        self.request_timeout = float(os.getenv('IRC_REQUEST_TIMEOUT', 300))
+        # limits on requested plus running transfers and their bandwidth in bytes per second (0 is unlimited)
+        self.scheduler = TransferScheduler(self.request_transfer,
+                                           int(os.getenv('IRC_MAX_TRANSFERS', 4)),
+                                           int(os.getenv('IRC_MAX_PER_SOURCE', 1)),
+                                           float(os.getenv('IRC_RATE_LIMIT', 0)),
+                                           float(os.getenv('IRC_SOURCE_RATE_LIMIT', 0)),
+                                           self.request_timeout)
         self.chatlist = set()
         self.md5 = {}
 
@@ -164,18 +727,27 @@ class Bot():
     def start(self) -> None:
         print('Bot Starting', flush=True)
         self.mqtt.listen()
-        self.mqtt.sub(self.mqtt_bridge, 'Commands/IRC/#')
-
+        if self.watchlist_batch:
+            self.announcements = BatchPublisher(self.mqtt, f'IRC/watchlist/{self.watchlist_framing}',
+                                                self.watchlist_batch, framing=self.watchlist_framing)
+        self.mqtt.route('Commands/IRC', self.mqtt_bridge)
+        self.mqtt.route('Commands/IRC/queue', self.queue_transfers)
+        self.mqtt.route('Commands/IRC/{operation}/{target}', self.mqtt_bridge)
+        self.mqtt.route('Commands/IRC/#', self.unknown_command, fallback=True)
+
+        self.irc.reactor.call_every(1, self.scheduler.pump)
+        self.irc.reactor.call_every(1, self.expire_resumes)
         self.irc.start()
 
     def stop(self) -> None:
         print('Bot Stopping', flush=True)
         self.irc.stop()
+        if self.announcements:
+            self.announcements.stop()
         self.mqtt.stop()
 
-    def mqtt_bridge(self, client: Client, userdata: Any, msg: MQTTMessage) -> None:
-        """MQTT Callback"""
-        operation, target = (msg.topic.split('/') + [0, 0])[2:4]
+    def mqtt_bridge(self, msg: MQTTMessage, operation: str = 0, target: str = 0) -> None:
+        """MQTT Route"""
         payload = msg.payload.decode()
         if operation == 'privmsg':
             self.irc.privmsg(target, payload)
@@ -184,27 +756,48 @@ class Bot():
             reply = self.transfer_status()
             self.mqtt.pub('Notifications/cmd-reply', reply)
         else:
-            self.mqtt.pub('Notifications/errors', 'Unknown IRC Command')
+            self.unknown_command(msg)
+
+    def unknown_command(self, msg: MQTTMessage) -> None:
+        """MQTT Route for every Commands/IRC topic no other route handles"""
+        self.mqtt.pub('Notifications/errors', 'Unknown IRC Command')
+
+    def queue_transfers(self, msg: MQTTMessage) -> None:
+        """MQTT Route, payload is the request message, object name and its sources separated by null bytes"""
+        message, name, *sources = msg.payload.decode().split('\x00')
+        self.scheduler.enqueue(name, message, sources)
+
+    def request_transfer(self, src: str, message: str) -> None:
+        self.irc.privmsg(src, message)
+        self.chatlist.add(src)
 
     def transfer_status(self):
+        scheduler = self.scheduler.status()
+        finished = [f'{t.name} {"verified" if t.verified else "UNVERIFIED"} {t.src} {t.pct_complete:0.2f}%'
+                    for t in list(self.transfers.finished)[-10:]]
         if len(self.transfers) == 0:
-            return 'No active transfers'
+            lines = [f'No active transfers, {scheduler}']
         else:
-            active = []
+            lines = ['', scheduler]
             for t in self.transfers.values():
-                active.append(f'{t.name} {t.fileopen} {t.src} {t.ip} {t.pct_complete}%')
-            return '\n' + '\n'.join(active)
+                lines.append(f'{t.name} {t.fileopen} {t.src} {t.ip} {t.pct_complete}%')
+        if finished:
+            lines += ['Recently finished:'] + finished
+        return '\n'.join(lines)
 
     @healthcheck
     def handle_watchlist(self, connection: ServerConnection, event: Event) -> None:
         """IRC Callback"""
-        if event.target in self.watchlist:
-            extract = re.match(r'.{4,16} +\d+x \[([^\]]+)\] (.*)', event.arguments[0])
+        if event.target in self.watchlist.channels:
+            extract = self.watchlist.match(event.target, event.arguments[0])
             if extract:
-                msg = b'\x00'.join([s.encode() for s in (event.source.nick, extract.group(1), extract.group(2))])
-                self.mqtt.pub('IRC/watchlist', msg)
+                meta, name = extract
+                if self.announcements:
+                    self.announcements.add((event.source.nick, meta, name))
+                else:
+                    self.mqtt.pub('IRC/watchlist', f'{event.source.nick}\x00{meta}\x00{name}'.encode())
         elif event.target == connection.nickname:
-            extract = re.match(r'.{21,35}\"([^\"]+)\".{3,15}\w{3}:([^\]]+)', event.arguments[0])
+            extract = MD5_NOTICE.match(event.arguments[0]) if '"' in event.arguments[0] else None
             if extract:
                 self.md5[extract.group(1)] = extract.group(2)
             elif 'MD5' in event.arguments[0]:
@@ -221,48 +814,91 @@ class Bot():
                 return
 
             cmd, name, v1, v2, size = (event.arguments[1].split() + [0])[:5]
-            if cmd == 'SEND':   # DCC SEND filename ip port size
+            if cmd in ('SEND', 'TSEND'):   # DCC SEND filename ip port size, TSEND is turbo mode without ACKs
                 ip = '.'.join(map(str, struct.unpack('BBBB', struct.pack('>L', int(v1)))))
-                metadata = {'name': name, 'src': src, 'ip': ip, 'port': v2, 'size': size, 'connection': self.irc.dcc()}
-            elif cmd == 'ACCEPT':  # DCC ACCEPT filename port position
+                metadata = {'name': name, 'src': src, 'ip': ip, 'port': v2, 'size': size, 'connection': self.irc.dcc(),
+                            'ack_mode': 'turbo' if cmd == 'TSEND' else self.dcc_ack_mode}
+            elif cmd == 'ACCEPT' and self.find_transfer_by_name(name):  # DCC ACCEPT filename port position
                 metadata = {'name': name, 'src': src, 'port': v1, 'startat': v2}
             else:
                 return
 
+            running = self.find_transfer_by_name(name)
+            if running and running.fileopen:
+                msg = f'Transfer of {name} from {running.src} is already underway, ignoring request from {src}'
+                self.mqtt.pub('Notifications/irc', msg, verbose=True)
+                return
+
             metadata['md5'] = self.md5.get(name)
             transfer = self.upsert_transfer(**metadata)
 
             if transfer.pct_complete == 100.:
+                self.transfers.remove(transfer, retain=False)
                 msg = f'{name} already transferred, ignoring request from {src}'
-            elif self.transfers.get(transfer.ip):
-                msg = f'SHENANIGANS! Existing transfer of {self.transfers[transfer.ip].name}' + \
-                      f' from {transfer.ip} is underway, cannot start {name} from {src}'
-            # elif cmd == 'SEND' and transfer['file'].received_bytes > 16384:
-            #     msg = (f'Requesting resume of {name}')
-            #     # DCC RESUME filename port position
-            #     # subtract 16384 bytes à la mirc as this seems to be one block
-            #     self.irc.ctcp('DCC', src, f"RESUME {name} {transfer.port} {transfer.received_bytes - 16384}")
+            elif cmd != 'ACCEPT' and transfer.resumable:
+                # DCC RESUME filename port position, the sender answers with DCC ACCEPT
+                self.irc.ctcp('DCC', src, f'RESUME {name} {transfer.port} {transfer.received_bytes}')
+                transfer.resume_sent = time.monotonic()
+                msg = f'Requesting resume of {name} from {src} at {transfer.received_bytes}'
             else:
+                allowed, transfer.request = self.scheduler.claim(src, name)
+                if not allowed:
+                    self.transfers.remove(transfer, retain=False)
+                    msg = f'Transfer limits reached, cannot start {name} from {src}'
+                    self.mqtt.pub('Notifications/irc', msg, verbose=True)
+                    return
                 try:
-                    transfer.start()
-                    self.transfers[transfer.ip] = transfer
+                    transfer.start(self.dcc_bufsize, self.dcc_queue_depth, self.dcc_checkpoint)
+                    transfer.connection.receive_into(self.handle_dcc_data, self.dcc_bufsize, self.handle_dcc_drained,
+                                                     buffers=transfer.buffer)
+                    self.transfers.activate(transfer)
                     msg = f'Started transfer of {name} from {src} at {transfer.ip}'
-                except DCCConnectionError as e:
-                    msg = f'Could not connect to {src} for {name} at {transfer.ip}: {e}'
+                except (DCCConnectionError, OSError) as e:
+                    transfer.abort()
+                    self.transfers.remove(transfer)
+                    self.scheduler.finish(src, transfer.request, False)
+                    msg = f'Could not start {name} from {src} at {transfer.ip}: {e}'
             self.mqtt.pub('Notifications/irc', msg, verbose=True)
             log('OPENED', transfer)
 
+    def expire_resumes(self) -> None:
+        """Forget transfers whose DCC RESUME got no ACCEPT within the request timeout, run from a reactor timer"""
+        now = time.monotonic()
+        for transfer in self.transfers.waiting():
+            if transfer.resume_sent and now - transfer.resume_sent > self.request_timeout:
+                log('TIMEOUT', f'No DCC ACCEPT for {transfer.name} from {transfer.src}')
+                self.transfers.remove(transfer, retain=False)
+
     def handle_dcc_msg(self, connection: ServerConnection, event: Event) -> None:
         """IRC Callback"""
-        transfer = self.transfers.get(event.source)
+        transfer = self.transfers.get(connection)
+        # every event is its own reactor tick, so only turbo transfers skip the ACK
+        self.receive_dcc(transfer, event.source, event.arguments[0], transfer and transfer.ack_mode != 'turbo')
+
+    def handle_dcc_data(self, connection: DCCConnection, data: memoryview) -> None:
+        """DCC bulk receive callback"""
+        transfer = self.transfers.get(connection)
+        self.receive_dcc(transfer, connection.peeraddress, data, transfer and transfer.ack_mode == 'every')
+
+    def handle_dcc_drained(self, connection: DCCConnection) -> None:
+        """DCC bulk receive callback, sends one ACK for everything read this reactor tick"""
+        transfer = self.transfers.get(connection)
+        if transfer and transfer.ack_mode == 'coalesce':
+            try:
+                transfer.send_ack()
+            except Exception as e:
+                log('WTF-UNKNOWN', e, transfer)
+                transfer.close()
+
+    def receive_dcc(self, transfer: Transfer, source: str, data, ack: bool) -> None:
         if transfer:
             try:
-                transfer.write(event.arguments[0])
-                if transfer.size <= 4294967295:
-                    format = '!I'  # 4-bit big-endian unsigned int
-                else:
-                    format = '!Q'  # 8-bit big-endian unsigned long long int
-                transfer.connection.send_bytes(struct.pack(format, transfer.received_bytes))
+                transfer.write(data)
+                if ack:
+                    transfer.send_ack()
+                delay = self.scheduler.throttle(transfer.src, len(data))
+                if delay:
+                    transfer.connection.throttle(delay)
             except AttributeError:
                 log('WTF-DC', transfer)
                 transfer.close()
@@ -270,39 +906,46 @@ class Bot():
                 log('WTF-UNKNOWN', e, transfer)
                 transfer.close()
         else:
-            log('WTF-NC', f'Received {len(event.arguments[0])} bytes from {event.source} without existing transfer')
+            log('WTF-NC', f'Received {len(data)} bytes from {source} without existing transfer')
 
     def handle_dcc_disconnect(self, connection: ServerConnection, event: Event) -> None:
         """IRC Callback"""
-        transfer = self.transfers.pop(event.source)
-        if transfer:
-            transfer.close()
+        transfer = self.transfers.get(connection)
+        if transfer and transfer.complete and transfer.rehashing:
+            # the sender finished while the writer is still hashing the partial file, closing now would wait for it
+            self.irc.reactor.call_later(1, lambda: self.handle_dcc_disconnect(connection, event))
+            return
+        transfer = self.transfers.pop(connection)
+        if not transfer:
+            log('WTF-NC', f'Disconnect from {event.source} without existing transfer')
+            return
+        transfer.close()
         log('CLOSED', transfer)
+        # without a published MD5 a complete transfer counts as done
+        done = transfer.verified or (transfer.complete and not transfer.md5)
+        self.scheduler.finish(transfer.src, transfer.request, done)
 
         verified = 'verified' if transfer.verified else 'UNVERIFIED'
-        msg = f"Received {verified} transfer of {transfer.pct_complete:0.2f}% of file {transfer.name}"
+        msg = f"Received {verified} transfer of {transfer.pct_complete:0.2f}% of file {transfer.name}" + \
+              f" ({transfer.ack_mode} ACKs, {transfer.acks_per_mb:0.1f}/MB)"
         self.mqtt.pub('Notifications/irc', msg, verbose=True)
 
-    def upsert_transfer(self, name: str, **kwargs) -> dict:
+    def upsert_transfer(self, name: str, **kwargs) -> Transfer:
         transfer = self.find_transfer_by_name(name)
         if not transfer:
             transfer = Transfer(name)
         transfer.update(**kwargs)
+        self.transfers.add(transfer)
         return transfer
 
-    def find_transfer_by_name(self, name: str) -> dict:
-        return self._find_transfer_by_x('name', name)
-
-    def find_transfer_by_src(self, src: str) -> dict:
-        return self._find_transfer_by_x('src', src)
+    def find_transfer_by_name(self, name: str) -> Transfer | None:
+        return self.transfers.find_by_name(pathlib.Path(name).name)
 
-    def find_transfer_by_ip(self, ip: str) -> dict:
-        return self._find_transfer_by_x('ip', ip)
+    def find_transfer_by_src(self, src: str) -> list:
+        return self.transfers.find_by_src(src)
 
-    def _find_transfer_by_x(self, field: str, value: str) -> Tuple[dict, None]:
-        for transfer in self.transfers.values():
-            if getattr(transfer, field) == value:
-                return transfer
+    def find_transfer_by_ip(self, ip: str) -> list:
+        return self.transfers.find_by_ip(ip)
 
     def debug_print(self, connection: ServerConnection, event: Event) -> None:
         """IRC Callback"""
@@ -318,5 +961,5 @@ if __name__ == "__main__":
         raise
     finally:
         bot.stop()
-        for transfer in bot.transfers:
+        for transfer in list(bot.transfers.values()):
             transfer.close()
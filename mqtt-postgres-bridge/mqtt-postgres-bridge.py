@@ -3,12 +3,10 @@
 Postgres-MQTT Bridge and Notifier
 """
 
-import collections
 import os
 import random
-import time
 
-from mqtt import MQTT  # type: ignore
+from mqtt import MQTT, FRAMINGS, unpack_records  # type: ignore
 from inventorydb import InventoryDB  # type: ignore
 
 
@@ -16,45 +14,70 @@ class Bridge():
     def __init__(self) -> None:
         dbname = os.getenv('POSTGRES_DB')
         dbpass = os.getenv('POSTGRES_PASSWORD')
-        self.db = InventoryDB('postgres', dbname, 'postgres', dbpass)
-        self.mqtt = MQTT(os.getenv('MQTT_BROKER'), client_id='postgres-mqtt-bridge')
+        self.db = InventoryDB('postgres', dbname, 'postgres', dbpass, pool_size=4)
+        self.mqtt = MQTT(os.getenv('MQTT_BROKER'), client_id='postgres-mqtt-bridge', workers=1)
         self.preamble = os.getenv('PREAMBLE')
 
-    def relay_objects(self, mosq, obj, msg):
+    def relay_objects(self, msg, framing='nul'):
         """
-        Add object to inventory when it arrives in broker (MQTT Callback)
+        Add objects to inventory when they arrive in broker (MQTT Route)
+
+        IRC/watchlist carries one NUL-joined object, IRC/watchlist/{framing} a batch framed by the IRC bridge
         """
-        object = [s.decode().strip() for s in msg.payload.split(b'\x00')]
-        self.db.add_record(*object)
+        if framing not in FRAMINGS:
+            print(f'Ignoring watchlist message on {msg.topic}, unknown framing {framing}', flush=True)
+            return
+        records = unpack_records(msg.payload, framing)
+        self.db.add_records([[s.strip() for s in record] for record in records])
 
     def queries(self, mosq, obj, msg):
         if b'search' in msg.payload[:6]:
             self.search(msg.payload.split(maxsplit=1)[1].decode())
+        elif b'find' in msg.payload[:4]:
+            self.search(msg.payload.split(maxsplit=1)[1].decode(), substring=True)
         elif b'sources' in msg.payload[:7]:
             self.sources(msg.payload.split(maxsplit=1)[1].decode())
         elif b'get' in msg.payload[:3]:
             self.get(msg.payload.split(maxsplit=1)[1].decode())
         elif msg.payload == b'dbreport':
-            pass
+            self.dbreport()
 
-    def search(self, data):
-        results = self.db.search_names(data)
-        msg = '\n'.join([f'{result[0]} : {result[1]}' for result in results]) if results else 'No results'
-        self.mqtt.pub('Notifications/cmd-reply', msg)
+    def search(self, data, substring=False):
+        results = self.db.iter_search_names(data, substring)
+        self.reply_pages(f'{result[0]} : {result[1]}' for result in results)
 
     def sources(self, data):
-        results = self.db.search_all(data)
-        msg = '\n'.join([f'{result[1]} {result[3]}' for result in results]) if results else 'No results'
+        results = self.db.iter_search_all(data)
+        self.reply_pages(f'{result[1]} {result[3]}' for result in results)
+
+    def reply_pages(self, lines, page_size=100):
+        """Publish result lines as they stream from the database, page_size lines per reply"""
+        page = []
+        published = False
+        for line in lines:
+            page.append(line)
+            if len(page) >= page_size:
+                self.mqtt.pub('Notifications/cmd-reply', '\n'.join(page))
+                page = []
+                published = True
+        if page or not published:
+            self.mqtt.pub('Notifications/cmd-reply', '\n'.join(page) if page else 'No results')
+
+    def dbreport(self):
+        msg = '\n'.join(f'{k}: {v}' for k, v in self.db.stats().items())
         self.mqtt.pub('Notifications/cmd-reply', msg)
 
-    def get(self, data):
+    def get(self, data, page_size=100):
+        """Queue matching objects with the IRC bridge scheduler, which picks and retries sources"""
         cmds = []
-        objmap = collections.defaultdict(lambda: set())
-        for name, source in [(r[3], r[1]) for r in self.db.search_all(data)]:
-            objmap[name].add(source)
-        for name, sources in {k: list(objmap[k]) for k in sorted(objmap, key=lambda k: len(objmap[k]))}.items():
-            target = sources[random.randint(0, len(sources) - 1)]
-            cmds.append((f'Commands/IRC/privmsg/{target}', f'{self.preamble} {name}', 2, False))
+        # rows arrive grouped by name, fewest sources first
+        for name, sources in self.db.iter_sources_by_name(data):
+            random.shuffle(sources)
+            payload = '\x00'.join([f'{self.preamble} {name}', name, *sources]).encode()
+            cmds.append(('Commands/IRC/queue', payload, 2, False))
+            if len(cmds) >= page_size:
+                self.mqtt.multipub(cmds)
+                cmds = []
         self.mqtt.multipub(cmds)
 
     def start(self) -> None:
@@ -62,11 +85,20 @@ class Bridge():
         print('MQTT startup complete')
 
         print('adding callbacks', flush=True)
-        self.mqtt.sub(self.relay_objects, 'IRC/watchlist')
+        self.mqtt.route('IRC/watchlist', self.relay_objects)
+        self.mqtt.route('IRC/watchlist/{framing}', self.relay_objects, qos=1)
         self.mqtt.sub(self.queries, 'Commands/Postgres')
 
-        while True:
-            time.sleep(0.1)
+        try:
+            while True:
+                # sleeps until records are queued and their flush_interval is up
+                self.db.wait_flush()
+                try:
+                    self.db.flush_records(force=False)
+                except Exception as e:
+                    print(f'ERROR: {str(e)}', flush=True)
+        finally:
+            self.db.flush_records()
 
 
 if __name__ == '__main__':
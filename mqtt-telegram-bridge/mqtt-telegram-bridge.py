@@ -20,7 +20,7 @@ Telegram-MQTT Bridge and Notifier
 """
 
 import os
-import time
+import threading
 
 from mqtt import MQTT  # type: ignore
 from telegrambot import TelegramBot, Update, CallbackContext  # type: ignore
@@ -31,6 +31,7 @@ class Bridge():
         self.cmds = [
             ('chatid', 'Returns your chat id.\n    /chatid', self.chat_id),
             ('down', 'Downloads a file from the server.\n    /down <file name|file path>', self.down),
+            ('find', 'Find object names containing text in Postgres\n    /find <text>', self.find),
             ('get', 'Requests object from the network.\n    /get <query>', self.get),
             ('help', 'Display helpful information on how to setup bot.\n    /help', self.help),
             ('humidities', 'Display current humidities.\n    /humidities', self.humidities),
@@ -65,6 +66,10 @@ class Bridge():
         else:
             context.bot.send_document(chat_id=update.message.chat_id, document=open(f'{current_dir}/{path}', 'rb'))
 
+    def find(self, update: Update, context: CallbackContext) -> None:
+        """Perform a substring object search in postgres when /find is issued. (Telegram Callback)"""
+        self.mqtt.pub('Commands/Postgres', f"find {' '.join(context.args)}")
+
     def get(self, update: Update, context: CallbackContext) -> None:
         """Get an object from the IRC network. (Telegram Callback)"""
         self.mqtt.pub('Commands/Postgres', f'get {context.args[0]}')
@@ -116,7 +121,7 @@ class Bridge():
         if self.bot.updater.running:
             print('Bot startup complete')
 
-        self.mqtt = MQTT(mqtt_broker, client_id='telegram-mqtt-bridge')
+        self.mqtt = MQTT(mqtt_broker, client_id='telegram-mqtt-bridge', workers=1)
         self.mqtt.listen()
         print('MQTT startup complete')
 
@@ -125,8 +130,7 @@ class Bridge():
         for cmd in self.cmds:
             self.bot.add_handler(cmd[0], cmd[2])
 
-        while True:
-            time.sleep(1)
+        threading.Event().wait()
 
 
 if __name__ == '__main__':
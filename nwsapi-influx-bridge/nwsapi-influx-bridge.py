@@ -5,30 +5,71 @@ Pull National Weather Service observations and send data to influxdb
 Author: Pete Ezzo <peter.ezzo@gmail.com>
 """
 
+import concurrent.futures
+import heapq
 import os
+import random
 import time
 import requests
 
 from influxdb import InfluxDB  # type: ignore
+from normalize import Normalizer  # type: ignore
 
 
 class WeatherPoller():
-    def __init__(self):
+    """
+    Fetch station observations over one pooled session
+
+    The ETag and Last-Modified of each station's latest observation are sent back as
+    If-None-Match/If-Modified-Since, a 304 or an observation with an already seen timestamp is skipped.
+    """
+    def __init__(self, base_url: str = 'https://api.weather.gov', concurrency: int = 4,
+                 timeout: float = 10.0, timeouts: dict = None):
+        self.base_url = base_url.rstrip('/')
         self.headers = {
             'accept': 'application/geo+json',
             'user-agent': 'iotcloud data comparator'
         }
+        self.timeout = timeout
+        self.timeouts = timeouts or {}
+        self.validators = {}  # station: {'If-None-Match': etag, 'If-Modified-Since': last modified}
+        self.last_timestamp = {}
+        self.normalizer = Normalizer.from_config(os.getenv('NORMALIZE_RULES'))
+
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def pull_latest(self, station):
+        """Yields the latest observation, nothing when it has not changed since the last pull"""
         print('pulling metric for', station, flush=True)
-        url = f'https://api.weather.gov/stations/{station}/observations/latest'
-        response = requests.get(url, headers=self.headers).json()
-        yield self._process_metric(response)
+        url = f'{self.base_url}/stations/{station}/observations/latest'
+        response = self.session.get(url, headers=self.validators.get(station),
+                                    timeout=self.timeouts.get(station, self.timeout))
+        if response.status_code == 304:
+            print('no new observation for', station, flush=True)
+            return
+        response.raise_for_status()
+        validators = {}
+        if 'ETag' in response.headers:
+            validators['If-None-Match'] = response.headers['ETag']
+        if 'Last-Modified' in response.headers:
+            validators['If-Modified-Since'] = response.headers['Last-Modified']
+        self.validators[station] = validators
+
+        timestamp, metrics = self._process_metric(response.json())
+        if self.last_timestamp.get(station) == timestamp:
+            print('no new observation for', station, flush=True)
+            return
+        self.last_timestamp[station] = timestamp
+        yield timestamp, metrics
 
     def pull_all(self, station):
         print('pulling all metrics for', station, flush=True)
-        url = f'https://api.weather.gov/stations/{station}/observations'
-        responses = requests.get(url, headers=self.headers).json()
+        url = f'{self.base_url}/stations/{station}/observations'
+        responses = self.session.get(url, timeout=self.timeouts.get(station, self.timeout)).json()
 
         for response in responses['features']:
             yield self._process_metric(response)
@@ -43,48 +84,95 @@ class WeatherPoller():
         print('metric pulled for timestamp', timestamp, flush=True)
 
         metrics = {}
-        for metric in response['properties']:
-            if metric == 'elevation':
-                continue
+        for metric, observation in response['properties'].items():
             try:
-                value = response['properties'][metric].get('value')
+                value = observation.get('value')
             except AttributeError:
                 continue
             if value is not None:
-                if metric == 'relativeHumidity':
-                    metric = 'humidity'
-                if metric in ['temperature', 'dewpoint', 'windSpeed', 'humidity']:
-                    value = float(value)
-
-                metrics[metric] = value
+                normalized = self.normalizer.normalize(metric, value)
+                if normalized is not None:
+                    metrics[normalized[0]] = normalized[1]
 
         return timestamp, metrics
 
 
+class PollSchedule():
+    """Per-station due times, each poll is rescheduled interval seconds later plus or minus jitter"""
+    def __init__(self, stations, interval: float, jitter: float) -> None:
+        self.interval = interval
+        self.jitter = jitter
+        now = time.monotonic()
+        # spread the first round over the jitter window instead of hitting every station at once
+        self.heap = [(now + random.uniform(0, jitter), station) for station in stations]
+        heapq.heapify(self.heap)
+
+    def due(self) -> list:
+        now = time.monotonic()
+        stations = []
+        while self.heap and self.heap[0][0] <= now:
+            stations.append(heapq.heappop(self.heap)[1])
+        return stations
+
+    def reschedule(self, station) -> None:
+        delay = max(0., self.interval + random.uniform(-self.jitter, self.jitter))
+        heapq.heappush(self.heap, (time.monotonic() + delay, station))
+
+    def wait(self) -> None:
+        if self.heap:
+            time.sleep(max(0., self.heap[0][0] - time.monotonic()))
+
+
+def poll_stations(poller, schedule, pool, write):
+    """Pull every due station concurrently and pass new observations to write(station, timestamp, metrics)"""
+    futures = {pool.submit(list, poller.pull_latest(station)): station for station in schedule.due()}
+    for future in concurrent.futures.as_completed(futures):
+        station = futures[future]
+        schedule.reschedule(station)
+        try:
+            for timestamp, metrics in future.result():
+                write(station, timestamp, metrics)
+        except Exception as e:
+            print(f'ERROR: {station}: {str(e)}', flush=True)
+    return len(futures)
+
+
 def poll_and_update():
-    db = InfluxDB('Environment')
+    db = InfluxDB('Environment', batching=True, spool_dir=os.getenv('INFLUX_SPOOL_DIR'))
     locations = os.getenv('OBSERVATION_STATIONS').split(';')
-    poller = WeatherPoller()
-
-    while True:
-        for location in locations:
-            # for timestamp, metrics in poller.pull_all(location):
-            for timestamp, metrics in poller.pull_latest(location):
-                try:
-                    data_payload = {
-                        'measurement': 'environmental',
-                        'tags': {
-                            'sensor': location
-                        },
-                        'time': timestamp,
-                        'fields': metrics
-                    }
-                    print(data_payload, flush=True)
-                    db.write(data_payload)
-                except Exception as e:
-                    print(f'ERROR: {str(e)}', flush=True)
-        print('sleeping', flush=True)
-        time.sleep(60 * 15)
+    concurrency = int(os.getenv('NWS_CONCURRENCY', 4))
+    # NWS_STATION_TIMEOUTS overrides the request timeout per station, e.g. KBOS=20;KJFK=15
+    timeouts = {}
+    for override in filter(None, os.getenv('NWS_STATION_TIMEOUTS', '').split(';')):
+        station, seconds = override.split('=')
+        timeouts[station.strip()] = float(seconds)
+    poller = WeatherPoller(os.getenv('NWS_API_URL', 'https://api.weather.gov'), concurrency,
+                           float(os.getenv('NWS_TIMEOUT', 10)), timeouts)
+    schedule = PollSchedule(locations, float(os.getenv('NWS_POLL_INTERVAL', 60 * 15)),
+                            float(os.getenv('NWS_POLL_JITTER', 60)))
+
+    def write(location, timestamp, metrics):
+        data_payload = {
+            'measurement': 'environmental',
+            'tags': {
+                'sensor': location
+            },
+            'time': timestamp,
+            'fields': metrics
+        }
+        print(data_payload, flush=True)
+        db.write(data_payload)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(concurrency, thread_name_prefix='nws-poll') as pool:
+            while True:
+                if poll_stations(poller, schedule, pool, write):
+                    db.flush()
+                    print('writer stats', db.stats(), flush=True)
+                print('sleeping', flush=True)
+                schedule.wait()
+    finally:
+        db.close()
 
 
 if __name__ == '__main__':